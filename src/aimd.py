@@ -0,0 +1,225 @@
+"""
+#####################################################################################################################
+
+    Module to adapt the number of requests in flight to remote models
+
+    For each interface a controller keeps a limit of requests in flight, that is raised additively,
+    by about one request per round trip, while the requests are successful and their latency is not
+    much higher than the best observed, and is cut by half when the provider signals overload
+    (status 429 or 529, or overloaded errors). The limit starts at cnfg.n_concurrent and stays within
+    1 and cnfg.aimd_max. The controllers persist across the runs of a sweep, and each change of the limit
+    is recorded in history, saved in the folder of the run.
+
+#####################################################################################################################
+"""
+
+import  time
+import  asyncio
+import  threading
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+
+decrease                = 0.5                   # multiplicative decrease on overload
+latency_factor          = 2.                    # latency above this factor of the best one is not healthy
+smoothing               = 0.2                   # weight of a new latency in the moving average
+overload_status         = ( 429, 529 )
+overload_errors         = ( "RateLimitError", "OverloadedError" )
+
+controllers             = dict()                # controller per interface, created on first use
+controllers_lock        = threading.Lock()      # guard for the creation of controllers from threads
+history                 = []                    # changes of the limits in the current run
+
+
+# ===================================================================================================================
+#
+#   - Controller
+#   - get_controller
+#   - max_in_flight
+#   - is_overload
+#   - reset_history
+#   - summary
+#
+# ===================================================================================================================
+
+class Controller( object ):
+    """
+    Additive-increase multiplicative-decrease limit of the requests in flight of one interface
+    """
+
+    def __init__( self, interface ):
+        """
+        params:
+            interface   [str] the interface of the models
+        """
+        self.interface  = interface
+        self.limit      = float( cnfg.n_concurrent )
+        self.in_flight  = 0
+        self.latency    = None                  # moving average of latency
+        self.best       = None                  # lowest moving average of latency
+        self.last_cut   = 0.
+        self.cond       = threading.Condition()
+        self.waiters    = []                    # ( event loop, future ) of the coroutines waiting for a slot
+        self.log()
+
+
+    def log( self ):
+        """
+        Record the current limit
+        NOTE: to be called with the lock acquired, or before the controller is shared
+        """
+        history.append( {
+                "time"          : time.strftime( "%H:%M:%S" ),
+                "interface"     : self.interface,
+                "limit"         : int( self.limit ),
+                "in_flight"     : self.in_flight,
+        } )
+
+
+    def try_acquire( self ):
+        """
+        Take a slot if available
+
+        return:         [bool] True if a slot was taken
+        """
+        with self.cond:
+            if self.in_flight < int( self.limit ):
+                self.in_flight  += 1
+                return True
+            return False
+
+
+    def acquire( self ):
+        """
+        Wait for a free slot, from a thread
+        """
+        with self.cond:
+            while self.in_flight >= int( self.limit ):
+                self.cond.wait()
+            self.in_flight  += 1
+
+
+    async def aacquire( self ):
+        """
+        Wait for a free slot, without blocking the event loop
+        """
+        while True:
+            with self.cond:
+                if self.in_flight < int( self.limit ):
+                    self.in_flight  += 1
+                    return
+                loop    = asyncio.get_running_loop()
+                waiter  = loop.create_future()
+                self.waiters.append( ( loop, waiter ) )
+            await waiter
+
+
+    def wake( self ):
+        """
+        Wake the coroutines waiting for a slot, also in the event loops of other threads
+        NOTE: to be called with the lock acquired
+        """
+        for loop, waiter in self.waiters:
+            try:
+                loop.call_soon_threadsafe( lambda w=waiter: w.done() or w.set_result( None ) )
+            except RuntimeError:
+                pass                            # the event loop is already closed
+        self.waiters.clear()
+
+
+    def release( self, seconds=None, overload=False ):
+        """
+        Free a slot, and adapt the limit to the outcome of the request
+
+        params:
+            seconds     [float] latency of a successful request, or None if failed
+            overload    [bool] the request failed because of overload of the provider
+        """
+        with self.cond:
+            self.in_flight  -= 1
+            old             = int( self.limit )
+
+            if overload:
+                # cut once per round trip, the requests already in flight report the same overload
+                now     = time.monotonic()
+                if now - self.last_cut > ( self.latency or 1. ):
+                    self.limit      = max( 1., self.limit * decrease )
+                    self.last_cut   = now
+            elif seconds is not None:
+                if self.latency is None:
+                    self.latency    = seconds
+                else:
+                    self.latency    = ( 1 - smoothing ) * self.latency + smoothing * seconds
+                self.best   = self.latency if self.best is None else min( self.best, self.latency )
+                if self.latency <= latency_factor * self.best:
+                    self.limit  = min( float( cnfg.aimd_max ), self.limit + 1. / self.limit )
+
+            if int( self.limit ) != old:
+                self.log()
+            self.cond.notify_all()
+            self.wake()
+
+
+def get_controller( interface ):
+    """
+    Return the controller of an interface
+
+    params:
+        interface   [str] the interface of the model
+
+    return:         [Controller] or None if the adaptive concurrency is not enabled
+    """
+    if not cnfg.aimd:
+        return None
+    with controllers_lock:
+        if interface not in controllers:
+            controllers[ interface ]    = Controller( interface )
+    return controllers[ interface ]
+
+
+def max_in_flight():
+    """
+    Return the cap of news in flight of the asynchronous execution, that should leave room for the
+    growth of the limit when the adaptive concurrency is enabled
+
+    return:         [int]
+    """
+    return cnfg.aimd_max if cnfg.aimd else cnfg.n_concurrent
+
+
+def is_overload( e, status ):
+    """
+    Return whether an error signals overload of the provider
+
+    params:
+        e           [Exception] the exception raised by the client
+        status      [int] HTTP status of the error, or None
+
+    return:         [bool]
+    """
+    return status in overload_status or type( e ).__name__ in overload_errors
+
+
+def reset_history():
+    """
+    Start the history of a new run, with the current limits
+    """
+    with controllers_lock:
+        history.clear()
+        for c in controllers.values():
+            with c.cond:
+                c.log()
+
+
+def summary():
+    """
+    Return the final, lowest and highest limit of each interface in the current run, to be reported in the log
+
+    return:         [dict] counters as in complete.stats
+    """
+    res     = dict()
+    for iface in sorted( { h[ "interface" ] for h in history } ):
+        limits  = [ h[ "limit" ] for h in history if h[ "interface" ] == iface ]
+        res[ f"concurrency {iface} final" ] = limits[ -1 ]
+        res[ f"concurrency {iface} min" ]   = min( limits )
+        res[ f"concurrency {iface} max" ]   = max( limits )
+    return res
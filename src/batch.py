@@ -0,0 +1,424 @@
+"""
+#####################################################################################################################
+
+    Module to execute the experiments with the batch APIs of the providers
+
+    The execution is done in three phases:
+    - render all prompts of the experiment as batch requests, split in jobs not exceeding max_bytes
+    - submit the jobs and poll until they finish
+    - map the replies back into the same structures returned by conversation.ask_news()
+
+    OpenAI requests carry all n_returns completions, while anthropic requests, allowing only one
+    return, are one for each (news, modality, sample index).
+    The identifiers of the jobs are saved in state_file as soon as they are submitted, so that an aborted
+    execution can be recovered with the -r flag, and polling resumes without submitting again.
+    Requests failed inside a job are completed interactively.
+
+#####################################################################################################################
+"""
+
+import  os
+import  json
+import  time
+
+import  prompt          as prmpt                # this module composes the prompts
+import  complete        as cmplt                # this module performs LLM completions
+import  conversation    as conv                 # this module handles conversations with the LLM
+import  imgcache                                # this module caches the images sent to remote models
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+
+state_file              = ".batch.json"         # file with the state of the submitted jobs, in the run folder
+requests_file           = ".batch_{}.jsonl"     # files with the requests of OpenAI jobs, in the run folder
+max_bytes               = 180 * 2 ** 20         # size of a job, below the limits of OpenAI and anthropic
+max_requests            = {                     # requests of a job, the limits of each provider
+        "openai"            : 50000,
+        "anthro"            : 100000,           # one request for each sample
+}
+poll_states             = ( "validating", "in_progress", "finalizing", "cancelling", "canceling" )
+
+
+# ===================================================================================================================
+#
+#   Utilities
+#   - custom_id
+#   - save_state
+#   - load_state
+#   - render_prompt
+#   - split_jobs
+#
+# ===================================================================================================================
+
+def custom_id( news_id, with_img, sample=None ):
+    """
+    Return the identifier of the request of a news, unique in a job
+    NOTE: anthropic accepts only letters, digits, '-' and '_'
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
+        sample      [int] index of the sample, for requests with one return only
+
+    return:         [str] the identifier
+    """
+    arm     = "img" if with_img else "noi"
+    if sample is None:
+        return f"{arm}-{news_id}"
+    return f"{arm}-{news_id}-{sample}"
+
+
+def save_state( state ):
+    """
+    Save the state of the jobs
+
+    params:
+        state       [dict] identifiers of the jobs and of their requests
+    """
+    with open( state_file, 'w' ) as f:
+        json.dump( state, f )
+
+
+def load_state():
+    """
+    Load the state of jobs previously submitted
+
+    return:         [dict] identifiers of the jobs and of their requests
+    """
+    with open( state_file, 'r' ) as f:
+        return json.load( f )
+
+
+def render_prompt( news_id, with_img, demographics ):
+    """
+    Return the prompt of a news, as in conversation.ask_news()
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
+        demographics[dict] demographic details, or None
+
+    return:         [list] the prompt
+                    [str] image name or "" if not with_img
+    """
+    return prmpt.format_prompt(
+                news_id,
+                conv.news_interface(),
+                mode        = cnfg.mode,
+                pre         = cnfg.dialogs_pre,
+                post        = cnfg.dialogs_post,
+                with_img    = with_img,
+                source      = cnfg.info_source,
+                more        = cnfg.info_more,
+                demographics= demographics,
+    )
+
+
+def split_jobs( requests ):
+    """
+    Split the requests in jobs not exceeding max_bytes, nor the max_requests of the interface.
+    The split depends only on the requests, so that it is the same when rendered again in a recovery.
+
+    params:
+        requests    [list] of [dict] requests
+
+    return:         [list] of [list] requests for each job
+    """
+    jobs    = [ [] ]
+    size    = 0
+    limit   = max_requests[ cnfg.interface ]
+    for r in requests:
+        r_size  = len( json.dumps( r ) )
+        if ( size + r_size > max_bytes or len( jobs[ -1 ] ) >= limit ) and len( jobs[ -1 ] ):
+            jobs.append( [] )
+            size    = 0
+        jobs[ -1 ].append( r )
+        size    += r_size
+    return jobs
+
+
+# ===================================================================================================================
+#
+#   OpenAI batch API
+#   - request_openai
+#   - submit_openai
+#   - poll_openai
+#
+# ===================================================================================================================
+
+def request_openai( news_id, with_img, prompt, user ):
+    """
+    Return the requests of a news in the format of the OpenAI batch API
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
+        prompt      [str] or [list] the prompt
+        user        [str] user identifier
+
+    return:         [list] with one [dict] request, carrying all returns
+    """
+    url     = "/v1/completions" if cnfg.mode == "cmpl" else "/v1/chat/completions"
+    body    = {
+            "model"             : cnfg.model,
+            "max_tokens"        : cnfg.max_tokens,
+            "n"                 : cnfg.n_returns,
+            "top_p"             : cnfg.top_p,
+            "temperature"       : cnfg.temperature,
+            "user"              : user
+    }
+    if cnfg.mode == "cmpl":
+        body[ "prompt" ]    = prompt
+    else:
+        body[ "messages" ]  = imgcache.resolve( prompt )
+    return [ { "custom_id": custom_id( news_id, with_img ), "method": "POST", "url": url, "body": body } ]
+
+
+def submit_openai( requests, index ):
+    """
+    Write the requests in a JSONL file, upload it and create the job
+
+    params:
+        requests    [list] of [dict] requests
+        index       [int] index of the job, for the file name
+
+    return:         [str] the id of the job
+    """
+    url     = "/v1/completions" if cnfg.mode == "cmpl" else "/v1/chat/completions"
+    fname   = requests_file.format( index )
+    with open( fname, 'w' ) as f:
+        for r in requests:
+            f.write( json.dumps( r ) + "\n" )
+    with open( fname, 'rb' ) as f:
+        finput  = cmplt.client.files.create( file=f, purpose="batch" )
+    job     = cmplt.client.batches.create(
+            input_file_id       = finput.id,
+            endpoint            = url,
+            completion_window   = "24h"
+    )
+    return job.id
+
+
+def poll_openai( job_id ):
+    """
+    Wait for the end of the job and extract the completions from its output file
+
+    params:
+        job_id      [str] the id of the job
+
+    return:         [dict] with the list of completions, keyed by custom_id
+    """
+    while True:
+        job     = cmplt.client.batches.retrieve( job_id )
+        if job.status not in poll_states:
+            break
+        if cnfg.VERBOSE:
+            c       = job.request_counts
+            done    = f"{c.completed} completed, {c.failed} failed of {c.total}" if c is not None else ""
+            print( f"batch {job_id} {job.status} {done}" )
+        time.sleep( cnfg.batch_poll )
+
+    if cnfg.VERBOSE:
+        print( f"batch {job_id} {job.status}" )
+    if job.status == "failed":
+        raise RuntimeError( f"ERROR: batch {job_id} failed: {job.errors}" )
+    if job.output_file_id is None:                  # expired or cancelled without any reply
+        return dict()
+
+    replies = dict()
+    content = cmplt.client.files.content( job.output_file_id ).text
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        r       = json.loads( line )
+        res     = r.get( "response" )
+        if r.get( "error" ) or res is None or res[ "status_code" ] != 200:
+            continue                                # failed requests are completed again interactively
+        choices = res[ "body" ][ "choices" ]
+        if cnfg.mode == "cmpl":
+            replies[ r[ "custom_id" ] ] = [ c[ "text" ] for c in choices ]
+        else:
+            replies[ r[ "custom_id" ] ] = [ c[ "message" ][ "content" ] for c in choices ]
+    return replies
+
+
+# ===================================================================================================================
+#
+#   Anthropic message batches API
+#   - request_anthro
+#   - submit_anthro
+#   - poll_anthro
+#
+# ===================================================================================================================
+
+def request_anthro( news_id, with_img, prompt, user ):
+    """
+    Return the requests of a news in the format of the anthropic message batches API
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] whether the prompt includes image and text
+        prompt      [list] the messages
+        user        [str] user identifier, unused
+
+    return:         [list] with one [dict] request for each sample
+    """
+    params  = {
+            "messages"          : imgcache.resolve( prompt ),
+            "model"             : cnfg.model,
+            "max_tokens"        : cnfg.max_tokens,
+            "top_p"             : cnfg.top_p,
+            "temperature"       : cnfg.temperature,
+    }
+    return [ { "custom_id": custom_id( news_id, with_img, k ), "params": params } for k in range( cnfg.n_returns ) ]
+
+
+def submit_anthro( requests, index ):
+    """
+    Create the job
+
+    params:
+        requests    [list] of [dict] requests
+        index       [int] index of the job, unused
+
+    return:         [str] the id of the job
+    """
+    job     = cmplt.client.messages.batches.create( requests=requests )
+    return job.id
+
+
+def poll_anthro( job_id ):
+    """
+    Wait for the end of the job and extract the completions from its results
+
+    params:
+        job_id      [str] the id of the job
+
+    return:         [dict] with the completion, keyed by custom_id
+    """
+    while True:
+        job     = cmplt.client.messages.batches.retrieve( job_id )
+        if job.processing_status in poll_states:
+            if cnfg.VERBOSE:
+                c   = job.request_counts
+                print( f"batch {job_id} {job.processing_status} {c.succeeded} succeeded, {c.errored} errored" )
+            time.sleep( cnfg.batch_poll )
+            continue
+        break
+
+    if cnfg.VERBOSE:
+        print( f"batch {job_id} {job.processing_status}" )
+    replies = dict()
+    for r in cmplt.client.messages.batches.results( job_id ):
+        if r.result.type == "succeeded":            # errored or expired requests are completed again interactively
+            replies[ r.custom_id ]  = r.result.message.content[ 0 ].text
+            cmplt.record_usage( r.result.message )
+    return replies
+
+
+# ===================================================================================================================
+#
+#   Main function
+#   - render
+#   - ask_news
+#
+# ===================================================================================================================
+
+def render( arms, demographics ):
+    """
+    Render the requests of all news for all modalities of the experiment
+
+    params:
+        arms        [list] of [bool] with_img, one for each modality of the experiment
+        demographics[dict] demographic details, or None
+
+    return:         [dict] with the information of each news, keyed by custom_id
+                    [list] of [list] requests for each job
+    """
+    user        = cmplt.user_name()
+    request     = request_anthro if cnfg.interface == "anthro" else request_openai
+    meta        = dict()
+    requests    = []
+
+    for with_img in arms:
+        for n in cnfg.news_ids:
+            pr, name    = render_prompt( n, with_img, demographics )
+            requests    += request( n, with_img, pr, user )
+            if cnfg.mode == "chat":
+                pr          = prmpt.prune_prompt( pr )  # remove the textual version of the image from the prompt
+            meta[ custom_id( n, with_img ) ]    = { "name": name, "prompt": pr }
+
+    return meta, split_jobs( requests )
+
+
+def ask_news( arms, demographics=None, agreement=False ):
+    """
+    Obtain the model completions of all news for all modalities of the experiment with batch jobs
+
+    params:
+        arms        [list] of [bool] with_img, one for each modality of the experiment
+        demographics[dict] demographic details, or None
+        agreement   [bool] include the agreement score
+
+    return:
+        [list] with one [tuple] for each modality, as returned by conversation.ask_news()
+    """
+    anthro          = cnfg.interface == "anthro"
+    submit          = submit_anthro if anthro else submit_openai
+    poll            = poll_anthro if anthro else poll_openai
+    if cmplt.client is None and not cnfg.DEBUG:
+        cmplt.client    = cmplt.set_anthro() if anthro else cmplt.set_openai()
+
+    # recover the jobs already submitted, then render and submit all the others
+    state           = None
+    if cnfg.RECOVER and os.path.isfile( state_file ):
+        state           = load_state()
+        if cnfg.VERBOSE:
+            print( f"recovering batch jobs {state[ 'jobs' ]}\n" )
+
+    if state is None or len( state[ "jobs" ] ) < state[ "n_jobs" ]:
+        meta, jobs      = render( arms, demographics )
+        if cnfg.DEBUG:
+            print( f"Program running in DEBUG mode, {len( jobs )} batch jobs rendered but not submitted" )
+            return [ ( [], [], dict(), [] ) for with_img in arms ]
+        if state is None:
+            state           = { "jobs": [], "n_jobs": len( jobs ), "meta": meta }
+        for i in range( len( state[ "jobs" ] ), len( jobs ) ):
+            state[ "jobs" ].append( submit( jobs[ i ], i ) )
+            save_state( state )                     # save as soon as possible, to recover without submitting again
+        cmplt.count( "batch jobs", len( jobs ) )
+
+    replies         = dict()
+    for job_id in state[ "jobs" ]:
+        replies.update( poll( job_id ) )
+    cmplt.count( "batch replies", len( replies ) )
+
+    results         = []
+    for with_img in arms:
+        prompts         = []
+        completions     = []
+        scores          = dict()
+        img_names       = []
+        for n in cnfg.news_ids:
+            m           = state[ "meta" ][ custom_id( n, with_img ) ]
+            if anthro:
+                completion  = [ replies.get( custom_id( n, with_img, k ) ) for k in range( cnfg.n_returns ) ]
+            else:
+                completion  = replies.get( custom_id( n, with_img ) )
+
+            # complete interactively the requests failed in the jobs
+            if completion is None or None in completion:
+                cmplt.count( "batch failures" )
+                pr, _       = render_prompt( n, with_img, demographics )
+                if anthro:
+                    completion  = [ c if c is not None else cmplt.complete_anthro( pr ) for c in completion ]
+                else:
+                    completion  = cmplt.do_complete( pr )
+
+            scores[ n ] = conv.check_reply( completion, agreement=agreement )
+            conv.save_record( with_img, n, m[ "prompt" ], completion, scores[ n ], m[ "name" ] )
+            prompts.append( m[ "prompt" ] )
+            completions.append( completion )
+            img_names.append( m[ "name" ] )
+        results.append( ( prompts, completions, scores, img_names ) )
+
+    return results
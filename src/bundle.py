@@ -0,0 +1,244 @@
+"""
+#####################################################################################################################
+
+    Module to compile the prompts of an experiment ahead of its execution
+
+    All the prompts of an experiment, for each news, modality, and variant of the dialogs and demographics
+    of a sweep, are rendered once into a bundle file. The bundle holds the text segments of the prompts,
+    each stored once even if shared by many prompts (like the dialogs before the news), and the image
+    of each prompt with the digest of its file (see imgcache.py). It records the names and digests of the
+    JSON files of news and dialogs it was compiled from, and is not used if they are swapped, or modified
+    where they are available. A worker without the JSON files can still use the bundle.
+
+    The execution memory-maps the bundle, and reads from it the prompts instead of composing them from
+    the JSON files of news and dialogs. The same bundle can be shared by many workers.
+    NOTE: only the text segments are memory-mapped, the index is parsed in each process, and its size
+    grows with the number of prompts, not with the size of their texts
+
+    Layout of the file:
+        magic           b"VISINFO-BUNDLE 1\n"
+        index size      8 bytes, little endian
+        index           JSON with the names of the source files and their digests, the list of news, the variants,
+                        the offsets of the segments, and for each prompt the ids of its segments,
+                        image name, image digest, completion flag
+        segments        the UTF-8 text segments, concatenated
+
+#####################################################################################################################
+"""
+
+import  os
+import  json
+import  mmap
+import  hashlib
+
+magic                   = b"VISINFO-BUNDLE 1\n"
+bundles                 = dict()                # Bundle for each version of the files already opened
+
+
+# ===================================================================================================================
+#
+#   - variant_key
+#   - prompt_key
+#   - source_digests
+#   - compile
+#   - Bundle
+#   - load
+#
+# ===================================================================================================================
+
+def variant_key( pre, post, source, more, demographics ):
+    """
+    Return the string identifying a variant of the prompts
+
+    params:
+        pre         [str] or [list of str] ids of text before the news content
+        post        [str] or [list of str] ids of text after the news content
+        source      [bool] add info about the source of the news
+        more        [bool] add more available info about the news
+        demographics [dict] demographics data, or None
+
+    return:         [str]
+    """
+    return json.dumps( {
+            "pre"           : pre,
+            "post"          : post,
+            "source"        : source,
+            "more"          : more,
+            "demographics"  : demographics,
+    }, sort_keys=True )
+
+
+def prompt_key( news_id, with_img, variant ):
+    """
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] the news contains an image
+        variant     [int] index of the variant in the bundle
+
+    return:         [str] the key of a prompt in the index of the bundle
+    """
+    return f"{news_id}|{int( with_img )}|{variant}"
+
+
+def source_digests( sources ):
+    """
+    params:
+        sources     [list] of [str] the files the prompts are composed from, with path
+
+    return:         [dict] with key the name of each file and value the hexadecimal sha256 digest of its content
+    """
+    digests = dict()
+    for src in sources:
+        with open( src, 'rb' ) as f:
+            digests[ os.path.basename( src ) ]  = hashlib.sha256( f.read() ).hexdigest()
+    return digests
+
+
+def compile( fname, news_ids, prompts, sources ):
+    """
+    Write a bundle file
+
+    params:
+        fname       [str] the bundle file, with path
+        news_ids    [list] of [str] ids of the news
+        prompts     [dict] with key ( news_id, with_img, variant key ) and value the [tuple] of text segments,
+                    image name, image digest or None, completion flag
+        sources     [list] of [str] the files the prompts are composed from, with path
+
+    return:         [tuple] number of prompts, number of distinct segments, size in bytes of the segments
+    """
+    variants    = []
+    segments    = dict()                            # text -> id
+    offsets     = []
+    blob        = []
+    size        = 0
+    index       = dict()
+
+    for ( news_id, with_img, vkey ), ( texts, fimage, digest, let_compl ) in prompts.items():
+        if vkey not in variants:
+            variants.append( vkey )
+        ids     = []
+        for t in texts:
+            if t not in segments:
+                data            = t.encode( "utf-8" )
+                segments[ t ]   = len( offsets )
+                offsets.append( [ size, len( data ) ] )
+                blob.append( data )
+                size            += len( data )
+            ids.append( segments[ t ] )
+        index[ prompt_key( news_id, with_img, variants.index( vkey ) ) ]  = [ ids, fimage, digest, let_compl ]
+
+    header  = json.dumps( {
+            "sources"       : source_digests( sources ),
+            "news"          : news_ids,
+            "variants"      : variants,
+            "segments"      : offsets,
+            "prompts"       : index,
+    } ).encode( "utf-8" )
+
+    tmp     = f"{fname}.{os.getpid()}"
+    with open( tmp, 'wb' ) as f:
+        f.write( magic )
+        f.write( len( header ).to_bytes( 8, "little" ) )
+        f.write( header )
+        for data in blob:
+            f.write( data )
+    os.replace( tmp, fname )                        # workers never see a partial bundle
+    return len( index ), len( offsets ), size
+
+
+class Bundle( object ):
+    """
+    A bundle file, memory-mapped, that can be used as prompt.rendered
+    """
+
+    def __init__( self, fname ):
+        """
+        params:
+            fname       [str] the bundle file, with path
+        """
+        with open( fname, 'rb' ) as f:
+            self.mm     = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+        assert self.mm[ : len( magic ) ] == magic, f"error: {fname} is not a prompt bundle"
+        start           = len( magic ) + 8
+        n_header        = int.from_bytes( self.mm[ len( magic ) : start ], "little" )
+        header          = json.loads( self.mm[ start : start + n_header ] )
+        self.base       = start + n_header
+        self.sources    = header.get( "sources", dict() )
+        self.news       = header[ "news" ]
+        self.variants   = header[ "variants" ]
+        self.vindex     = { v: i for i, v in enumerate( self.variants ) }
+        self.segments   = header[ "segments" ]
+        self.prompts    = header[ "prompts" ]
+
+
+    def segment( self, i ):
+        """
+        params:
+            i           [int] id of the segment
+
+        return:         [str] the text segment
+        """
+        offset, length  = self.segments[ i ]
+        return self.mm[ self.base + offset : self.base + offset + length ].decode( "utf-8" )
+
+
+    def stale( self, sources ):
+        """
+        params:
+            sources     [list] of [str] the files the prompts are composed from, with path
+
+        return:         [list] of [str] names of the files other than those of the bundle, or modified,
+                        the files not available are not checked
+        """
+        paths   = { os.path.basename( src ): src for src in sources }
+        stale   = []
+        for n in sorted( set( paths ) | set( self.sources ) ):
+            if n not in paths or n not in self.sources:
+                stale.append( n )                   # a file swapped for another
+            elif os.path.isfile( paths[ n ] ) and source_digests( [ paths[ n ] ] )[ n ] != self.sources[ n ]:
+                stale.append( n )                   # a file modified, checked only where available
+        return stale
+
+
+    def has_variant( self, vkey ):
+        """
+        params:
+            vkey        [str] the variant, as returned by variant_key()
+
+        return:         [bool] True if the prompts of the variant are in the bundle
+        """
+        return vkey in self.vindex
+
+
+    def __contains__( self, key ):
+        news_id, with_img, vkey = key
+        return vkey in self.vindex and prompt_key( news_id, with_img, self.vindex[ vkey ] ) in self.prompts
+
+
+    def __getitem__( self, key ):
+        """
+        params:
+            key         [tuple] news id, with_img, and variant as returned by variant_key()
+
+        return:         [tuple] as the values of prompt.render_news()
+        """
+        news_id, with_img, vkey         = key
+        ids, fimage, digest, let_compl  = self.prompts[ prompt_key( news_id, with_img, self.vindex[ vkey ] ) ]
+        pre_text, body, post            = [ self.segment( i ) for i in ids ]
+        return ( pre_text, body + post ), fimage, let_compl, digest
+
+
+def load( fname ):
+    """
+    Return a bundle file, memory-mapped the first time, and again if the file is compiled again
+
+    params:
+        fname       [str] the bundle file, with path
+
+    return:         [Bundle]
+    """
+    key     = ( os.path.abspath( fname ), os.stat( fname ).st_mtime_ns )
+    if key not in bundles:
+        bundles[ key ]  = Bundle( fname )
+    return bundles[ key ]
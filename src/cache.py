@@ -0,0 +1,245 @@
+"""
+#####################################################################################################################
+
+    Module to cache model completions across executions
+
+    Each completion is stored in an SQLite file under a key that is the hash of everything determining
+    the request: model, mode, the prompt with images replaced by their digest, sampling parameters,
+    and the index of the sample among the n_returns of the prompt.
+    When the file exceeds the configured size, the least recently used completions are evicted.
+
+    The cache is used according to cnfg.cache_mode:
+        "off"       no caching (default)
+        "use"       return cached completions, and store the new ones
+        "refresh"   do not return cached completions, but store the new ones
+
+#####################################################################################################################
+"""
+
+import  json
+import  time
+import  hashlib
+import  sqlite3
+import  threading
+
+import  imgcache                                # this module caches the images sent to remote models
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+
+cache_file              = "../data/.cache.db"   # file with the cached completions
+evict_fraction          = 0.9                   # after eviction the cache is reduced to this fraction of its size
+resync_puts             = 100                   # puts between recounts of the size, also written by other processes
+
+db                      = None                  # connection to the cache file, opened on first use
+db_lock                 = threading.Lock()      # guard for the connection used from threads
+total                   = 0                     # size of the completions in the cache file, kept while storing
+n_puts                  = 0                     # puts since the last recount of the size
+
+
+# ===================================================================================================================
+#
+#   Keys
+#   - digest
+#   - canonical
+#   - make_keys
+#
+# ===================================================================================================================
+
+def digest( data ):
+    """
+    Return the hash of data
+
+    params:
+        data        [str] or [bytes]
+
+    return:         [str] hexadecimal sha256 digest
+    """
+    if isinstance( data, str ):
+        data    = data.encode( "utf-8" )
+    return hashlib.sha256( data ).hexdigest()
+
+
+def canonical( prompt ):
+    """
+    Return a copy of the prompt with b64encoded images replaced by their digest, and handles of images kept
+
+    params:
+        prompt      [str] or [list] or [dict] the prompt or a part of it
+
+    return:         the prompt with the same structure
+    """
+    if isinstance( prompt, list ):
+        return [ canonical( p ) for p in prompt ]
+    if isinstance( prompt, dict ):
+        c       = dict()
+        for k, v in prompt.items():
+            if imgcache.is_handle( v ):
+                c[ k ]  = v                                 # already compact, see imgcache.py
+            elif k == "url" and isinstance( v, str ) and v.startswith( "data:" ):
+                c[ k ]  = digest( v )                       # OpenAI image
+            elif k == "data" and prompt.get( "type" ) == "base64":
+                c[ k ]  = digest( v )                       # anthropic image
+            else:
+                c[ k ]  = canonical( v )
+        return c
+    return prompt
+
+
+def make_keys( prompt, image=None ):
+    """
+    Return the keys of all the n_returns completions of a request
+
+    params:
+        prompt      [str] or [list] the prompt
+        image       [PIL.JpegImagePlugin.JpegImageFile] or None, for HuggingFace models
+
+    return:         [list] of [str] keys
+    """
+    img     = None
+    if image is not None:
+        img     = digest( image.tobytes() + str( image.size ).encode() )
+    request = [
+            cnfg.model,
+            cnfg.mode,
+            canonical( prompt ),
+            img,
+            cnfg.temperature,
+            cnfg.top_p,
+            cnfg.max_tokens,
+            cnfg.repetition_penalty,
+    ]
+    base    = digest( json.dumps( request, sort_keys=True ) )
+    return [ digest( f"{base}:{i}" ) for i in range( cnfg.n_returns ) ]
+
+
+# ===================================================================================================================
+#
+#   Storage
+#   - connect
+#   - active
+#   - get
+#   - put
+#   - recount
+#   - evict
+#
+# ===================================================================================================================
+
+def connect():
+    """
+    Open the cache file, creating it if necessary
+
+    return:         [sqlite3.Connection]
+    """
+    global db, total
+    if db is None:
+        db      = sqlite3.connect( cache_file, timeout=60, check_same_thread=False )
+        db.execute( "CREATE TABLE IF NOT EXISTS completions "
+                    "( key TEXT PRIMARY KEY, value TEXT, size INTEGER, atime REAL )" )
+        db.execute( "CREATE INDEX IF NOT EXISTS completions_atime ON completions ( atime )" )
+        db.commit()
+        total   = recount( db )
+    return db
+
+
+def active():
+    """
+    Return whether the cache is used in the current execution
+
+    return:         [bool]
+    """
+    return cnfg.cache_mode in ( "use", "refresh" ) and not cnfg.DEBUG and cnfg.interface != "none"
+
+
+def get( keys ):
+    """
+    Return the cached completions, only if all of them are found
+
+    params:
+        keys        [list] of [str] keys, as returned by make_keys()
+
+    return:         [list] with completions [str], or None
+    """
+    if cnfg.cache_mode != "use":
+        return None
+    with db_lock:
+        c       = connect()
+        marks   = ','.join( '?' * len( keys ) )
+        rows    = c.execute( f"SELECT key, value FROM completions WHERE key IN ({marks})", keys ).fetchall()
+        if len( rows ) < len( keys ):
+            return None
+        c.execute( f"UPDATE completions SET atime=? WHERE key IN ({marks})", [ time.time() ] + keys )
+        c.commit()
+    values  = dict( rows )
+    return [ values[ k ] for k in keys ]
+
+
+def put( keys, completions ):
+    """
+    Store the completions, evicting the least recently used ones if the cache is too large.
+    Requests with missing completions are not stored
+
+    params:
+        keys        [list] of [str] keys, as returned by make_keys()
+        completions [list] with completions [str]
+    """
+    global total, n_puts
+    if completions is None or len( completions ) != len( keys ) or None in completions:
+        return
+    now     = time.time()
+    rows    = [ ( k, v, len( v.encode( "utf-8" ) ), now ) for k, v in zip( keys, completions ) ]
+    marks   = ','.join( '?' * len( keys ) )
+    with db_lock:
+        c       = connect()
+        old     = c.execute( f"SELECT COALESCE( SUM( size ), 0 ) FROM completions WHERE key IN ({marks})",
+                             keys ).fetchone()[ 0 ]
+        c.executemany( "INSERT OR REPLACE INTO completions VALUES ( ?, ?, ?, ? )", rows )
+        c.commit()
+        total   += sum( r[ 2 ] for r in rows ) - old
+        n_puts  += 1
+        if n_puts >= resync_puts:
+            total   = recount( c )
+        evict( c )
+
+
+def recount( c ):
+    """
+    Return the size of all the completions in the cache file
+    NOTE: to be called with the lock acquired, or before the connection is shared
+
+    params:
+        c           [sqlite3.Connection]
+
+    return:         [int] size in bytes
+    """
+    global n_puts
+    n_puts  = 0
+    return c.execute( "SELECT COALESCE( SUM( size ), 0 ) FROM completions" ).fetchone()[ 0 ]
+
+
+def evict( c ):
+    """
+    Delete the least recently used completions, if the cache exceeds cnfg.cache_size.
+    The size is kept in total, and counted again before evicting
+    NOTE: to be called with the lock acquired
+
+    params:
+        c           [sqlite3.Connection]
+    """
+    global total
+    limit   = cnfg.cache_size * 2 ** 20
+    if total <= limit:
+        return
+    total   = recount( c )
+    if total <= limit:
+        return
+    excess  = total - evict_fraction * limit
+    freed   = 0
+    old     = []
+    for key, s in c.execute( "SELECT key, size FROM completions ORDER BY atime" ):
+        old.append( ( key, ) )
+        freed   += s
+        if freed >= excess:
+            break
+    c.executemany( "DELETE FROM completions WHERE key=?", old )
+    c.commit()
+    total   -= freed
@@ -29,6 +29,11 @@ kwargs      = {
     'info_more':            True,                   # include info about the news date
 
     # 'news_amount':          2,                    # optional, limit the number of news to process
+    # 'exec_mode':            "async",              # optional, keep several news in flight
+    # 'n_concurrent':         8,                    # optional, number of news in flight in async mode
+    # 'n_fanout':             10,                   # optional, number of samples requested concurrently
+    # optional, limits per minute of the provider tier (see ratelimit.py)
+    # 'rate_limits':          { "anthro": { "rpm": 50, "itpm": 50000, "otpm": 10000 } },
 
     'n_returns':            10,                     # number of completions to generate
     'max_tokens':           1200,                   # max number of tokens in completions
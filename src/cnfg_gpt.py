@@ -21,6 +21,11 @@ kwargs      = {
     'info_more':            True,                   # include info about the news date
 
     # 'news_amount':          2,                    # optional, limit the number of news to process
+    # 'exec_mode':            "async",              # optional, keep several news in flight
+    # 'exec_mode':            "batch",              # optional, use the batch API for large sweeps
+    # 'n_concurrent':         8,                    # optional, number of news in flight in async mode
+    # optional, limits per minute of the provider tier (see ratelimit.py)
+    # 'rate_limits':          { "openai": { "rpm": 5000, "tpm": 4000000 } },
 
     'n_returns':            10,                     # number of completions to generate
     'max_tokens':           1200,                   # max number of tokens in completions
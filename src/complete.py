@@ -12,8 +12,19 @@ import  time
 import  random
 import  gc
 import  platform
+import  getpass
+import  asyncio
+import  threading
+import  email.utils
+from    concurrent.futures  import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from    PIL         import Image
 
+import  ratelimit                               # this module paces requests under the rate limits
+import  cache                                   # this module caches completions across executions
+import  hedge                                   # this module hedges slow requests
+import  aimd                                    # this module adapts the requests in flight
+import  imgcache                                # this module caches the images sent to remote models
+
 key_file                = "../data/.key.txt"    # file with the current OpenAI API access key
 hf_file                 = "../data/.hf.txt"     # file with the current huggingface access key
 anthro_file             = "../data/.anth.txt"   # file with the current anthropic access key
@@ -23,8 +34,26 @@ llava_next_n_max        = 50                    # maximum number of returns for
 qwen2_vl_n_max          = 1                     # NOTE: Qwen2-VL-7B provide inconsisten results with more than 1!!
 
 client                  = None                  # the language model client object
+aclient                 = None                  # the asynchronous client object, used with exec_mode "async"
+afanout                 = None                  # semaphore capping the samples in flight, used with exec_mode "async"
 cnfg                    = None                  # parameter obj assigned by main_exec.py
-delay                   = 120                   # delay in seconds after OpenAI/anthropic internal errors
+backoff_base            = 2                     # initial delay in seconds after OpenAI/anthropic transient errors
+backoff_max             = 120                   # maximum delay in seconds after OpenAI/anthropic transient errors
+stats                   = dict()                # counters of the current run, reported in the log by save_res.py
+usage                   = []                    # tokens used by each request of the current run
+stats_lock              = threading.Lock()      # guard for the counters updated from threads
+
+# transient errors, that are worth retrying, when the exception carries no HTTP status
+retry_errors            = (
+        "APITimeoutError",
+        "APIConnectionError",
+        "RateLimitError",
+        "InternalServerError",
+        "OverloadedError",
+        "ServiceUnavailableError",
+        "TimeoutError",
+        "ConnectionError",
+)
 
 # ===================================================================================================================
 #
@@ -35,6 +64,8 @@ delay                   = 120                   # delay in seconds after OpenAI/
 #   - set_hf
 #   - set_openai
 #   - set_anthro
+#   - set_openai_async
+#   - set_anthro_async
 #
 # ===================================================================================================================
 
@@ -148,7 +179,7 @@ def set_openai():
     """
     from    openai          import OpenAI
     key             = open( key_file, 'r' ).read().rstrip()
-    client          = OpenAI( api_key=key )
+    client          = OpenAI( api_key=key, base_url=cnfg.base_url, max_retries=0 )     # retries are handled by send()
     return client
 
 
@@ -159,10 +190,473 @@ def set_anthro():
     """
     import anthropic
     key             = open( anthro_file, 'r' ).read().rstrip()
-    client          = anthropic.Anthropic( api_key=key )
+    client          = anthropic.Anthropic( api_key=key, base_url=cnfg.base_url, max_retries=0 )     # retries are handled by send()
+    return client
+
+
+def set_openai_async():
+    """
+    Parse the OpenAI key and return the asynchronous client
+        NOTE: the client is bound to the event loop where it is first used, see conversation.ask_news_async()
+    """
+    from    openai          import AsyncOpenAI
+    key             = open( key_file, 'r' ).read().rstrip()
+    client          = AsyncOpenAI( api_key=key, base_url=cnfg.base_url, max_retries=0 )    # retries are handled by asend()
+    return client
+
+
+def set_anthro_async():
+    """
+    Parse the anthropic key and return the asynchronous client
+        NOTE: the client is bound to the event loop where it is first used, see conversation.ask_news_async()
+    """
+    import anthropic
+    key             = open( anthro_file, 'r' ).read().rstrip()
+    client          = anthropic.AsyncAnthropic( api_key=key, base_url=cnfg.base_url, max_retries=0 )    # retries are handled by asend()
     return client
 
 
+# ===================================================================================================================
+#
+#   Requests to remote models, within rate limits, with retries on transient errors and hedging of slow requests
+#   - user_name
+#   - reset_stats
+#   - count
+#   - record_usage
+#   - error_status
+#   - is_retryable
+#   - retry_after
+#   - backoff
+#   - output_tokens
+#   - retry_or_raise
+#   - take_hedge
+#   - settle_later
+#   - hedged
+#   - ahedged
+#   - send
+#   - asend
+#
+# ===================================================================================================================
+
+def user_name():
+    """
+    Return the user and host, passed to OpenAI to identify the requests
+    NOTE: os.getlogin() fails without a controlling terminal, like in background executions
+
+    return:         [str] user@host
+    """
+    try:
+        user    = os.getlogin()
+    except OSError:
+        user    = getpass.getuser()
+    return user + '@' + platform.node()
+
+
+def reset_stats():
+    """
+    Reset the counters of the current run
+    """
+    with stats_lock:
+        stats.clear()
+        usage.clear()
+    hedge.reset()
+    aimd.reset_history()
+
+
+def count( key, n=1 ):
+    """
+    Increment a counter of the current run
+
+    params:
+        key         [str] name of the counter
+        n           [int] increment
+    """
+    with stats_lock:
+        stats[ key ]    = stats.get( key, 0 ) + n
+
+
+def record_usage( res ):
+    """
+    Record the tokens used by a request, including the tokens read from and written to the prompt cache
+
+    params:
+        res         the response of an OpenAI/anthropic client
+    """
+    u       = getattr( res, "usage", None )
+    if u is None:
+        return
+    if hasattr( u, "input_tokens" ):                # anthropic
+        cache_write = getattr( u, "cache_creation_input_tokens", None ) or 0
+        cache_read  = getattr( u, "cache_read_input_tokens", None ) or 0
+        n_in        = u.input_tokens
+        n_out       = u.output_tokens
+    else:                                           # OpenAI, with automatic caching and no writing cost
+        details     = getattr( u, "prompt_tokens_details", None )
+        cache_write = 0
+        cache_read  = getattr( details, "cached_tokens", None ) or 0
+        n_in        = u.prompt_tokens - cache_read
+        n_out       = u.completion_tokens
+    record  = {
+            "time"          : f"{time.time():.3f}",
+            "model"         : getattr( res, "model", cnfg.model ),
+            "input"         : n_in,
+            "output"        : n_out,
+            "cache_write"   : cache_write,
+            "cache_read"    : cache_read,
+    }
+    with stats_lock:
+        usage.append( record )
+        for k in ( "input", "output", "cache_write", "cache_read" ):
+            stats[ f"tokens {k}" ]  = stats.get( f"tokens {k}", 0 ) + record[ k ]
+
+
+def error_status( e ):
+    """
+    Return the HTTP status of an OpenAI/anthropic exception
+
+    params:
+        e           [Exception] the exception raised by the client
+
+    return:         [int] the status or None
+    """
+    status  = getattr( e, "status_code", None )
+    if status is None:
+        status  = getattr( getattr( e, "response", None ), "status_code", None )
+    return status
+
+
+def is_retryable( e ):
+    """
+    Classify an exception as transient (rate limits, overload, server errors, timeouts) or fatal
+    (authentication, bad requests, and any other unexpected error)
+
+    params:
+        e           [Exception] the exception raised by the client
+
+    return:         [bool] True if the request is worth retrying
+    """
+    status  = error_status( e )
+    if status is not None:
+        return status in ( 408, 409, 429 ) or status >= 500       # 529 is anthropic overloaded
+    return type( e ).__name__ in retry_errors
+
+
+def retry_after( e ):
+    """
+    Return the delay requested by the server in the headers of the error response
+
+    params:
+        e           [Exception] the exception raised by the client
+
+    return:         [float] seconds or None
+    """
+    headers = getattr( getattr( e, "response", None ), "headers", None )
+    if headers is None:
+        return None
+    try:
+        if "retry-after-ms" in headers:
+            return float( headers[ "retry-after-ms" ] ) / 1000.
+        if "retry-after" in headers:
+            value   = headers[ "retry-after" ]
+            try:
+                return float( value )
+            except ValueError:                  # the header can be an HTTP date as well
+                return email.utils.parsedate_to_datetime( value ).timestamp() - time.time()
+    except Exception:
+        return None
+    return None
+
+
+def backoff( attempt, e ):
+    """
+    Return the delay before retrying, as exponential backoff with full jitter,
+    but not shorter than the delay requested by the server
+
+    params:
+        attempt     [int] number of the failed attempt, starting from 0
+        e           [Exception] the exception raised by the client
+
+    return:         [float] seconds
+    """
+    wait    = random.uniform( 0, min( backoff_max, backoff_base * 2 ** attempt ) )
+    after   = retry_after( e )
+    if after is not None:
+        wait    = max( wait, min( after, backoff_max ) )
+    return wait
+
+
+def output_tokens( res ):
+    """
+    Return the output tokens in the usage of an OpenAI/anthropic response
+
+    params:
+        res         the response of the client
+
+    return:         [int] tokens or None
+    """
+    usage   = getattr( res, "usage", None )
+    if usage is None:
+        return None
+    if hasattr( usage, "output_tokens" ):
+        return usage.output_tokens
+    return getattr( usage, "completion_tokens", None )
+
+
+def retry_or_raise( attempt, e ):
+    """
+    Decide whether a failed request should be retried, and account for it
+
+    params:
+        attempt     [int] number of the failed attempt, starting from 0
+        e           [Exception] the exception raised by the client
+
+    return:         [float] seconds to wait before retrying, otherwise the exception is raised again
+    """
+    if not is_retryable( e ):
+        count( "fatal errors" )
+        raise e
+    if attempt + 1 >= cnfg.retry_max or stats.get( "retries", 0 ) >= cnfg.retry_budget:
+        count( "retries exhausted" )
+        raise e
+    count( "retries" )
+    count( f"retries after {error_status( e ) or type( e ).__name__}" )
+    wait    = backoff( attempt, e )
+    if cnfg.VERBOSE:
+        print( f"catched error {e}, sleeping {wait:.1f} seconds and trying again" )
+    return wait
+
+
+def take_hedge( ctrl ):
+    """
+    Account for a duplicate request, with a slot of its own when the adaptive concurrency is enabled
+
+    params:
+        ctrl        [aimd.Controller] or None
+
+    return:         [bool] True if the request can be hedged
+    """
+    if ctrl is not None and not ctrl.try_acquire():
+        return False
+    if hedge.take():
+        return True
+    if ctrl is not None:
+        ctrl.release()
+    return False
+
+
+def settle_later( future, ticket, ctrl ):
+    """
+    Settle the rate limits and free the slot of one of the two requests of a hedge, when it ends
+
+    params:
+        future      [concurrent.futures.Future] or [asyncio.Future] of the request
+        ticket      [tuple] as returned by ratelimit.reserve()
+        ctrl        [aimd.Controller] or None
+    """
+    def done( f ):
+        tokens  = 0
+        if not f.cancelled() and f.exception() is None:
+            tokens  = output_tokens( f.result() )
+        ratelimit.settle( ticket, tokens )
+        if ctrl is not None:
+            ctrl.release()
+
+    future.add_done_callback( done )
+
+
+def hedged( create, cargs, prompt, n=1 ):
+    """
+    Call create(), and if it is slower than the threshold of hedge.py call it again,
+    returning the first response. A thread cannot be stopped, the response of the slower call is discarded,
+    and its share of the limits is given back only when it ends.
+
+    params:
+        create      [function] the method of the client creating the completion
+        cargs       [dict] arguments of create()
+        prompt      [str] or [list] the prompt of the request, for the estimate of tokens
+        n           [int] number of returns of the request
+
+    return:         the response of the client
+    """
+    start   = time.monotonic()
+    limit   = hedge.threshold( cnfg.interface, cnfg.model )
+    if limit is None:
+        res     = create( **cargs )
+        hedge.record( cnfg.interface, cnfg.model, time.monotonic() - start )
+        return res
+
+    ctrl    = aimd.get_controller( cnfg.interface )
+    pool    = ThreadPoolExecutor( max_workers=2 )
+    first   = pool.submit( create, **cargs )
+    try:
+        done, _     = wait( [ first ], timeout=limit )
+        if done or not take_hedge( ctrl ):
+            res     = first.result()
+            hedge.record( cnfg.interface, cnfg.model, time.monotonic() - start )
+            return res
+
+        count( "hedges" )
+        ticket  = ratelimit.reserve( cnfg.interface, cnfg.model, prompt, n=n )  # the duplicate is not delayed
+        second  = pool.submit( create, **cargs )
+        loser   = second
+        pending = { first, second }
+        try:
+            while pending:
+                done, pending   = wait( pending, return_when=FIRST_COMPLETED )
+                for f in done:
+                    if f.exception() is None:
+                        if f is second:
+                            count( "hedges won" )
+                            loser   = first
+                        # the latency of the request as seen by the caller, the slow tail is kept in the window
+                        hedge.record( cnfg.interface, cnfg.model, time.monotonic() - start )
+                        return f.result()
+            raise f.exception()                 # both calls failed
+        finally:
+            # the caller accounts for the winner, the duplicate accounts for the slower call still running
+            settle_later( loser, ticket, ctrl )
+    finally:
+        pool.shutdown( wait=False, cancel_futures=True )
+
+
+async def ahedged( create, cargs, prompt, n=1 ):
+    """
+    Await create(), and if it is slower than the threshold of hedge.py send it again,
+    returning the first response and cancelling the other request.
+    The requests still pending are cancelled also when the caller is cancelled.
+
+    params:
+        create      [coroutine function] the method of the asynchronous client creating the completion
+        cargs       [dict] arguments of create()
+        prompt      [str] or [list] the prompt of the request, for the estimate of tokens
+        n           [int] number of returns of the request
+
+    return:         the response of the client
+    """
+    start   = time.monotonic()
+    limit   = hedge.threshold( cnfg.interface, cnfg.model )
+    if limit is None:
+        res     = await create( **cargs )
+        hedge.record( cnfg.interface, cnfg.model, time.monotonic() - start )
+        return res
+
+    ctrl    = aimd.get_controller( cnfg.interface )
+    first   = asyncio.ensure_future( create( **cargs ) )
+    pending = { first }
+    try:
+        done, _ = await asyncio.wait( [ first ], timeout=limit )
+        if done or not take_hedge( ctrl ):
+            res     = await first
+            hedge.record( cnfg.interface, cnfg.model, time.monotonic() - start )
+            return res
+
+        count( "hedges" )
+        ticket  = ratelimit.reserve( cnfg.interface, cnfg.model, prompt, n=n )  # the duplicate is not delayed
+        second  = asyncio.ensure_future( create( **cargs ) )
+        settle_later( second, ticket, ctrl )    # also when cancelled
+        pending = { first, second }
+        while pending:
+            done, pending   = await asyncio.wait( pending, return_when=asyncio.FIRST_COMPLETED )
+            for f in done:
+                if f.exception() is None:
+                    if f is second:
+                        count( "hedges won" )
+                    # the latency of the request as seen by the caller, the slow tail is kept in the window
+                    hedge.record( cnfg.interface, cnfg.model, time.monotonic() - start )
+                    return f.result()
+        raise f.exception()                 # both requests failed
+    finally:
+        for f in pending:
+            f.cancel()
+
+
+def send( create, cargs, prompt, n=1 ):
+    """
+    Send a request to a remote model within its rate limits, retrying on transient errors
+
+    params:
+        create      [function] the method of the client creating the completion
+        cargs       [dict] arguments of create()
+        prompt      [str] or [list] the prompt of the request, for the estimate of tokens
+        n           [int] number of returns of the request
+
+    return:         the response of the client
+    """
+    ctrl    = aimd.get_controller( cnfg.interface )
+    attempt = 0
+    while True:
+        if ctrl is not None:
+            ctrl.acquire()
+        seconds, error  = None, None
+        try:
+            ticket  = ratelimit.acquire( cnfg.interface, cnfg.model, prompt, n=n )
+            tokens  = 0                     # no output tokens are produced by failed requests
+            start   = time.monotonic()
+            try:
+                res     = hedged( create, cargs, prompt, n=n )
+                tokens  = output_tokens( res )
+                seconds = time.monotonic() - start
+            except Exception as e:          # catch EVERY exception to ensure compatibility with OpenAI/anthropic versions
+                error   = e
+            finally:
+                ratelimit.settle( ticket, tokens )
+        finally:                            # the slot is freed also when the request is cancelled
+            if ctrl is not None:
+                overload    = error is not None and aimd.is_overload( error, error_status( error ) )
+                ctrl.release( seconds, overload=overload )
+        if error is not None:
+            time.sleep( retry_or_raise( attempt, error ) )
+            attempt += 1
+            continue
+        count( "requests" )
+        record_usage( res )
+        return res
+
+
+async def asend( create, cargs, prompt, n=1 ):
+    """
+    Send a request to a remote model within its rate limits, retrying on transient errors,
+    without blocking the event loop
+
+    params:
+        create      [coroutine function] the method of the asynchronous client creating the completion
+        cargs       [dict] arguments of create()
+        prompt      [str] or [list] the prompt of the request, for the estimate of tokens
+        n           [int] number of returns of the request
+
+    return:         the response of the client
+    """
+    ctrl    = aimd.get_controller( cnfg.interface )
+    attempt = 0
+    while True:
+        if ctrl is not None:
+            await ctrl.aacquire()
+        seconds, error  = None, None
+        try:
+            ticket  = await ratelimit.aacquire( cnfg.interface, cnfg.model, prompt, n=n )
+            tokens  = 0                     # no output tokens are produced by failed requests
+            start   = time.monotonic()
+            try:
+                res     = await ahedged( create, cargs, prompt, n=n )
+                tokens  = output_tokens( res )
+                seconds = time.monotonic() - start
+            except Exception as e:
+                error   = e
+            finally:
+                ratelimit.settle( ticket, tokens )
+        finally:                            # the slot is freed also when the request is cancelled
+            if ctrl is not None:
+                overload    = error is not None and aimd.is_overload( error, error_status( error ) )
+                ctrl.release( seconds, overload=overload )
+        if error is not None:
+            await asyncio.sleep( retry_or_raise( attempt, error ) )
+            attempt += 1
+            continue
+        count( "requests" )
+        record_usage( res )
+        return res
+
+
 # ===================================================================================================================
 #
 #   - complete_anthro
@@ -173,6 +667,7 @@ def set_anthro():
 #   - complete_gemma
 #   - complete_hf
 #
+#   - complete_model
 #   - do_complete
 #
 # ===================================================================================================================
@@ -195,22 +690,15 @@ def complete_anthro( prompt ):
  
     # arguments for completion calls
     cargs   = {
-            "messages"          : prompt,
+            "messages"          : imgcache.resolve( prompt ),
             "model"             : cnfg.model,
             "max_tokens"        : cnfg.max_tokens,
             "top_p"             : cnfg.top_p,
             "temperature"       : cnfg.temperature,
     }
 
-    # there have been anthropic._exceptions.OverloadedError errors, this is a very simple workaround
-    # if the problem will repeat more often, and is not solved, the solution is exponential backoff
-    try:
-        res     = client.messages.create( **cargs )
-    except Exception as e:              # catch EVERY exception to ensure compatibility with OpenAI/anthropic versions
-        if cnfg.VERBOSE:
-            print( f"catched error {e}, sleeping {delay} seconds and trying again" )
-        time.sleep( delay )             # just sleep for a while and then try again
-        res     = client.messages.create( **cargs )
+    # there have been anthropic._exceptions.OverloadedError errors, send() retries with exponential backoff
+    res     = send( client.messages.create, cargs, prompt )
     return res.content[ 0 ].text
 
 
@@ -241,34 +729,36 @@ def complete_openai( prompt ):
 
     if client is None:              # check if openai has already a client, otherwise set it
         client  = set_openai()
-    user    = os.getlogin() + '@' + platform.node()
+    user    = user_name()
 
     if cnfg.mode == "cmpl":
         assert isinstance( prompt, str ), "ERROR: for completion-mode models, the prompt should be a string"
-        res     = client.completions.create(
-            model                   = cnfg.model,
-            prompt                  = prompt,
-            max_tokens              = cnfg.max_tokens,
-            n                       = cnfg.n_returns,
-            top_p                   = cnfg.top_p,
-            temperature             = cnfg.temperature,
-            stop                    = None,
-            user                    = user
-        )
+        cargs   = {
+                "model"             : cnfg.model,
+                "prompt"            : prompt,
+                "max_tokens"        : cnfg.max_tokens,
+                "n"                 : cnfg.n_returns,
+                "top_p"             : cnfg.top_p,
+                "temperature"       : cnfg.temperature,
+                "stop"              : None,
+                "user"              : user
+        }
+        res     = send( client.completions.create, cargs, prompt, n=cnfg.n_returns )
         return [ t.text for t in res.choices ]
 
     if cnfg.mode == "chat":
         assert isinstance( prompt, list ), "ERROR: for chat-mode models, the prompt should be a list"
         # NOTE: for gpt-4o stop=None raises Error code: 400! do not use it
-        res     = client.chat.completions.create(
-            model                   = cnfg.model,
-            messages                = prompt,
-            max_tokens              = cnfg.max_tokens,
-            n                       = cnfg.n_returns,
-            top_p                   = cnfg.top_p,
-            temperature             = cnfg.temperature,
-            user                    = user
-        )
+        cargs   = {
+                "model"             : cnfg.model,
+                "messages"          : imgcache.resolve( prompt ),
+                "max_tokens"        : cnfg.max_tokens,
+                "n"                 : cnfg.n_returns,
+                "top_p"             : cnfg.top_p,
+                "temperature"       : cnfg.temperature,
+                "user"              : user
+        }
+        res     = send( client.chat.completions.create, cargs, prompt, n=cnfg.n_returns )
         return [ t.message.content for t in res.choices ]
 
     return None
@@ -294,8 +784,8 @@ def complete_llava( model, processor, prompt, image ):
     # dummy image as workaround for llava-next bug (see comment above)
     if image is None:
         image   = Image.new( mode='L', size=native_res, color="black" )
-    else:
-        image   = image.resize( native_res )
+    elif image.size != native_res:
+        image   = image.resize( native_res )            # images from prompt.image_pil() are already resized
 
     inputs      = processor(
             images          = image,
@@ -341,7 +831,8 @@ def complete_chameleon( model, processor, prompt, image ):
         text        = prompt
     else:
         text        = prompt + "<image>"
-        image       = image.resize( native_res )
+        if image.size != native_res:
+            image       = image.resize( native_res )
 
     inputs      = processor(
             images          = image,
@@ -377,7 +868,7 @@ def complete_qwen( model, processor, prompt, image ):
 
     return:         [list] with completions [str]
     """
-    if image is not None:
+    if image is not None and image.size != native_res:
         image   = image.resize( native_res )
     text        = processor.apply_chat_template(
                     prompt,
@@ -526,7 +1017,7 @@ def complete_hf( prompt, image ):
     return None
 
 
-def do_complete( prompt, image=None ):
+def complete_model( prompt, image=None ):
     """
     Feed a prompt to any model and get the list of completions returned.
 
@@ -538,6 +1029,8 @@ def do_complete( prompt, image=None ):
 
     return:         [list] with completions [str]
     """
+    global client
+
     match cnfg.interface:
 
         case 'openai':
@@ -547,10 +1040,13 @@ def do_complete( prompt, image=None ):
             return complete_none()
 
         case 'anthro':
-            # anthropic allows only one return per completion
-            completions     = []
-            for i in range( cnfg.n_returns ):
-                completions.append( complete_anthro( prompt ) )
+            # anthropic allows only one return per completion, the samples are requested concurrently
+            # and map() returns them in a stable order
+            if client is None and not cnfg.DEBUG:   # set the client before the threads may race on it
+                client  = set_anthro()
+            n_workers       = min( cnfg.n_fanout, cnfg.n_returns )
+            with ThreadPoolExecutor( max_workers=n_workers ) as pool:
+                completions = list( pool.map( lambda i: complete_anthro( prompt ), range( cnfg.n_returns ) ) )
             return completions
 
         case 'hf':
@@ -577,3 +1073,192 @@ def do_complete( prompt, image=None ):
         case _:
             print( f"WARNING: model interface '{cnfg.interface}' not supported" )
             return None
+
+
+
+def do_complete( prompt, image=None ):
+    """
+    Feed a prompt to any model and get the list of completions returned, through the completion cache.
+
+    params:
+        prompt      [str] or [list] the prompt for completion models,
+                    or the messages for chat completion models
+        image       [PIL.JpegImagePlugin.JpegImageFile] or None, for OpenAI and Qwen
+                    the image is embedded in the propmt
+
+    return:         [list] with completions [str]
+    """
+    if not cache.active():
+        return complete_model( prompt, image=image )
+
+    keys            = cache.make_keys( prompt, image=image )
+    completions     = cache.get( keys )
+    if completions is not None:
+        count( "cache hits" )
+        return completions
+    count( "cache misses" )
+    completions     = complete_model( prompt, image=image )
+    cache.put( keys, completions )
+    return completions
+
+# ===================================================================================================================
+#
+#   Asynchronous completions, used with exec_mode "async"
+#   - reset_async
+#   - acomplete_anthro
+#   - acomplete_openai
+#   - acomplete_model
+#   - ado_complete
+#
+# ===================================================================================================================
+
+def reset_async():
+    """
+    Discard the asynchronous client and semaphore, that are bound to the event loop where they were first used.
+    To be called at the beginning of each new event loop.
+    """
+    global aclient, afanout
+    aclient     = None
+    afanout     = None
+
+
+async def acomplete_anthro( prompt ):
+    """
+    Feed a prompt to an anthropic model through the asynchronous client, and get one completion.
+
+    params:
+        prompt      [list] the messages for chat-mode models
+
+    return:         [str] the completion
+    """
+    global aclient
+    if cnfg.DEBUG:  return "test_only"
+
+    if aclient is None:             # check if anthropic has already an asynchronous client, otherwise set it
+        aclient = set_anthro_async()
+
+    cargs   = {
+            "messages"          : imgcache.resolve( prompt ),
+            "model"             : cnfg.model,
+            "max_tokens"        : cnfg.max_tokens,
+            "top_p"             : cnfg.top_p,
+            "temperature"       : cnfg.temperature,
+    }
+
+    res     = await asend( aclient.messages.create, cargs, prompt )
+    return res.content[ 0 ].text
+
+
+async def acomplete_openai( prompt ):
+    """
+    Feed a prompt to an OpenAI model through the asynchronous client, and get the list of completions returned.
+
+    params:
+        prompt      [str] or [list] the prompt for completion-mode models,
+                    or the messages for chat-mode models
+
+    return:         [list] with completions [str]
+    """
+    global aclient
+    if cnfg.DEBUG:  return [ "test_only" ]
+
+    if aclient is None:             # check if openai has already an asynchronous client, otherwise set it
+        aclient = set_openai_async()
+    user    = user_name()
+
+    if cnfg.mode == "cmpl":
+        assert isinstance( prompt, str ), "ERROR: for completion-mode models, the prompt should be a string"
+        cargs   = {
+                "model"             : cnfg.model,
+                "prompt"            : prompt,
+                "max_tokens"        : cnfg.max_tokens,
+                "n"                 : cnfg.n_returns,
+                "top_p"             : cnfg.top_p,
+                "temperature"       : cnfg.temperature,
+                "stop"              : None,
+                "user"              : user
+        }
+        res     = await asend( aclient.completions.create, cargs, prompt, n=cnfg.n_returns )
+        return [ t.text for t in res.choices ]
+
+    if cnfg.mode == "chat":
+        assert isinstance( prompt, list ), "ERROR: for chat-mode models, the prompt should be a list"
+        cargs   = {
+                "model"             : cnfg.model,
+                "messages"          : imgcache.resolve( prompt ),
+                "max_tokens"        : cnfg.max_tokens,
+                "n"                 : cnfg.n_returns,
+                "top_p"             : cnfg.top_p,
+                "temperature"       : cnfg.temperature,
+                "user"              : user
+        }
+        res     = await asend( aclient.chat.completions.create, cargs, prompt, n=cnfg.n_returns )
+        return [ t.message.content for t in res.choices ]
+
+    return None
+
+
+async def acomplete_model( prompt, image=None ):
+    """
+    Feed a prompt to a remote model and get the list of completions returned, without blocking the event loop.
+    The HuggingFace interface is not supported, since local models are bound to the GPU, and are executed
+    with do_complete().
+
+    params:
+        prompt      [str] or [list] the prompt for completion models,
+                    or the messages for chat completion models
+        image       unused, kept for compatibility with do_complete()
+
+    return:         [list] with completions [str]
+    """
+    global afanout
+
+    match cnfg.interface:
+
+        case 'openai':
+            return await acomplete_openai( prompt )
+
+        case 'none':
+            return complete_none()
+
+        case 'anthro':
+            # anthropic allows only one return per completion, the samples of all news in flight
+            # share the cap of cnfg.n_fanout requests, and gather() returns them in a stable order
+            if afanout is None:
+                afanout     = asyncio.Semaphore( cnfg.n_fanout )
+
+            async def sample():
+                async with afanout:
+                    return await acomplete_anthro( prompt )
+
+            return list( await asyncio.gather( *[ sample() for i in range( cnfg.n_returns ) ] ) )
+
+        case _:
+            print( f"WARNING: model interface '{cnfg.interface}' not supported in async mode" )
+            return None
+
+
+async def ado_complete( prompt, image=None ):
+    """
+    Feed a prompt to a remote model and get the list of completions returned, without blocking the event loop,
+    through the completion cache.
+
+    params:
+        prompt      [str] or [list] the prompt for completion models,
+                    or the messages for chat completion models
+        image       unused, kept for compatibility with do_complete()
+
+    return:         [list] with completions [str]
+    """
+    if not cache.active():
+        return await acomplete_model( prompt, image=image )
+
+    keys            = cache.make_keys( prompt, image=image )
+    completions     = cache.get( keys )
+    if completions is not None:
+        count( "cache hits" )
+        return completions
+    count( "cache misses" )
+    completions     = await acomplete_model( prompt, image=image )
+    cache.put( keys, completions )
+    return completions
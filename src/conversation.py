@@ -6,48 +6,100 @@
 #####################################################################################################################
 """
 
+import  os
 import  sys
 import  re
 import  copy
+import  time
+import  queue
+import  asyncio
+import  threading
 import  numpy           as np
-import  pickle
 
 import  prompt          as prmpt                # this module composes the prompts
 import  complete        as cmplt                # this module performs LLM completions
+import  cache                                   # this module caches completions across executions
+import  aimd                                    # this module adapts the requests in flight
+import  save_res                                # this module saves results
 
 cnfg                    = None                  # parameter obj assigned by main_exec.py
+poll_stop               = 0.5                   # seconds between checks of the stop of the pipeline, for threads
 
 # ===================================================================================================================
 #
-#   - save_backup
-#   - load_backup
+#   - save_record
+#   - load_records
 #   - check_reply_bool
 #   - check_reply_likert
 #   - check_reply
+#   - news_interface
+#   - resume_news
+#   - collect_news
+#   - QueueDepth
+#   - prepare_news
+#   - score_news
 #   - ask_news
+#   - ask_news_async
+#   - ask_both
+#   - ask_both_async
 #
 # ===================================================================================================================
 
-def save_backup( back_noi, back_img ):
+def save_record( with_img, news, pr, completion, res, name, seconds=None ):
     """
-    save the current processes stories on temporary backup
-    input:
-        back_noi    [tuple] no-image backup or None
-        back_img    [tuple] with-image backup or None
-    """
-    with open( cnfg.back_file, 'wb' ) as f:
-        pickle.dump( ( back_noi, back_img ), f )
-
+    Append the results of one processed news to the stream of results of the execution, that serves
+    also as backup for recovering an aborted execution.
+    The b64encoded images of the prompt are replaced by their digest.
 
-def load_backup():
+    params:
+        with_img    [bool] whether the prompt includes image and text
+        news        [str] news identifier
+        pr          [str] or [list] the prompt
+        completion  [list] the completions
+        res         [dict] or [np.array] the scores of the completions
+        name        [str] the image name
+        seconds     [float] time taken by the news, or None
+    """
+    record  = {
+            "news":         news,
+            "with_img":     with_img,
+            "image":        name,
+            "prompt":       cache.canonical( pr ),
+            "completions":  completion,
+            "scores":       save_res.encode_score( res ),
+            "seconds":      seconds,
+            "time":         time.strftime( "%Y-%m-%d %H:%M:%S" ),
+    }
+    save_res.append_record( cnfg.stream_file, record )
+
+
+def load_records():
     """
-    load the processes stories saved on temporary backup
+    Replay the stream of results of the execution, a news processed more than once keeps only its last record.
+    The results are in the order of cnfg.news_ids, as expected by save_res.write_dialogs().
+
     return:
-        [tuple] with [list] of processed stories, [list] with scores of processed stories
+        [tuple] with no-image results first, and with-image results second, each a [tuple] of
+                prompts, completions, scores, img_names, done_news, or None if no news was processed
     """
-    with open( cnfg.back_file, 'rb' ) as f:
-        s   = pickle.load( f )
-    return s
+    records = dict()
+    if os.path.isfile( cnfg.stream_file ):
+        for r in save_res.read_records( cnfg.stream_file ):
+            records[ ( r[ "with_img" ], r[ "news" ] ) ]  = r
+
+    results = []
+    for with_img in ( False, True ):
+        arm     = [ records[ ( with_img, n ) ] for n in cnfg.news_ids if ( with_img, n ) in records ]
+        if not arm:
+            results.append( None )
+            continue
+        prompts     = [ r[ "prompt" ] for r in arm ]
+        completions = [ r[ "completions" ] for r in arm ]
+        scores      = { r[ "news" ]: save_res.decode_score( r[ "scores" ] ) for r in arm }
+        img_names   = [ r[ "image" ] for r in arm ]
+        done_news   = [ r[ "news" ] for r in arm ]
+        results.append( ( prompts, completions, scores, img_names, done_news ) )
+    return tuple( results )
 
 
 def check_reply_bool( completion ):
@@ -213,9 +265,152 @@ def check_reply( completion, agreement=True ):
     return check_reply_bool( completion )
 
 
+def news_interface():
+    """
+    Return the interface instructing the prompt formation.
+    Note that cnfg.interface is not enough to instruct prompt formation, several models
+    have different prompt formats even if under the same cnfg.interface
+
+    return:         [str] the interface name used by prompt.format_prompt()
+    """
+    if "Qwen" in cnfg.model:
+        return "qwen"
+    if "gemma" in cnfg.model:
+        return "gemma"
+    return cnfg.interface
+
+
+def resume_news( with_img, backup ):
+    """
+    Return the news still to process by ask_news(), possibly skipping those of a previous backup
+
+    params:
+        with_img    [bool] whether the prompts include image and text
+        backup      [tuple] possible previous backed data, with no-image first, and with-image second
+
+    return:
+        [list] of news identifiers
+    """
+    todo_news       = copy.deepcopy( cnfg.news_ids )
+
+    back_noi, back_img  = backup
+    back            = back_img if with_img else back_noi
+    if back:
+        if cnfg.VERBOSE:
+            i_mode      = "with" if with_img else "without"
+            print( f"recovering from aborted executions {i_mode} images\n" )
+        done_news       = back[ -1 ]
+        todo_news       = [ n for n in todo_news if n not in done_news ]  # keep the original order of news
+
+    return todo_news
+
+
+def collect_news( with_img ):
+    """
+    Return the results of ask_news() from the stream of results, in the order of cnfg.news_ids,
+    since news may be completed out of order in async mode or after a recovery
+
+    params:
+        with_img    [bool] whether the prompts include image and text
+
+    return:
+        [tuple] of prompts, completions, scores, img_names
+    """
+    back            = load_records()[ 1 if with_img else 0 ]
+    if back is None:
+        return [], [], dict(), []
+    prompts, completions, scores, img_names, _  = back
+    return prompts, completions, scores, img_names
+
+
+class QueueDepth( object ):
+    """
+    Samples of the depth of a queue of the pipeline, reported among the statistics of the run
+    """
+
+    def __init__( self, name ):
+        """
+        params:
+            name        [str] name of the queue
+        """
+        self.name       = name
+        self.n          = 0
+        self.total      = 0
+        self.peak       = 0
+
+
+    def sample( self, depth ):
+        """
+        params:
+            depth       [int] current number of items in the queue
+        """
+        self.n          += 1
+        self.total      += depth
+        self.peak       = max( self.peak, depth )
+
+
+    def report( self ):
+        if self.n:
+            cmplt.count( f"queue {self.name} max", self.peak )
+            cmplt.count( f"queue {self.name} mean", round( self.total / self.n, 2 ) )
+
+
+def prepare_news( n, with_img, interface, demographics=None ):
+    """
+    First stage of the pipeline: compose the prompt of a news, and open its image for local models
+
+    params:
+        n           [str] news identifier
+        with_img    [bool] whether the prompts include image and text
+        interface   [str] the interface used to format the prompt, see news_interface()
+        demographics[dict] demographic details, or None
+
+    return:
+        [tuple] of news, prompt, image name, image or None, start time
+    """
+    t_start         = time.time()
+    if cnfg.VERBOSE:
+        i_mode      = "img + txt" if with_img else "only text"
+        print( f"====> Processing news {n} {i_mode} <====" )
+
+    pr, name        = prmpt.format_prompt(
+                        n,
+                        interface,
+                        mode        = cnfg.mode,
+                        pre         = cnfg.dialogs_pre,
+                        post        = cnfg.dialogs_post,
+                        with_img    = with_img,
+                        source      = cnfg.info_source,
+                        more        = cnfg.info_more,
+                        demographics= demographics,
+    )
+    # images are embedded in the prompt for remote models, and passed separately to HuggingFace models
+    image           = prmpt.image_pil( n ) if with_img and cnfg.interface == "hf" else None
+    return n, pr, name, image, t_start
+
+
+def score_news( item, with_img, agreement=False ):
+    """
+    Last stage of the pipeline: check the replies of a news and append its record to the stream of results
+
+    params:
+        item        [tuple] of news, prompt, image name, completions, start time
+        with_img    [bool] whether the prompts include image and text
+        agreement   [bool] include the agreement score
+    """
+    n, pr, name, completion, t_start    = item
+    if cnfg.interface == "openai":
+        pr          = prmpt.prune_prompt( pr ) # remove the textual version of the image from the prompt
+    res             = check_reply( completion, agreement=agreement )
+    save_record( with_img, n, pr, completion, res, name, seconds=time.time() - t_start )
+
+
 def ask_news( with_img=True, demographics=None, agreement=False, backup=(None,None) ):
     """
-    Prepare the prompts and obtain the model completions
+    Prepare the prompts and obtain the model completions.
+    The work is done by a pipeline of three stages, connected by queues of at most cnfg.pipeline_depth news:
+    the preparation of prompts and images, the completions, and the check of the replies.
+    In this way preparing the next prompts overlaps with waiting for the model.
 
     params:
         with_img    [bool] whether the prompts include image and text
@@ -229,77 +424,234 @@ def ask_news( with_img=True, demographics=None, agreement=False, backup=(None,No
                     completions [list] the list of completions
                     scores      [list] of the yes/not answers
     """
-    prompts         = []            # initialize the list of prompts
-    completions     = []            # initialize the list of completions
-    scores          = dict()        # initialize the yes/not replies
-    img_names       = []            # initialize the list of image names
-    done_news       = []            # initialize the processed news
-    todo_news       = copy.deepcopy( cnfg.news_ids )
-
-    back_noi, back_img  = backup
-    if with_img:
-        if back_img is not None:
-            if cnfg.VERBOSE:
-                print( "recovering from aborted executions with images\n" )
-            prompts, completions, scores, img_names, done_news  = back_img
-            todo_news       = list( set( todo_news ) - set( done_news ) )
-    else:
-        if back_noi is not None:
-            if cnfg.VERBOSE:
-                print( "recovering from aborted executions without images\n" )
-            prompts, completions, scores, img_names, done_news  = back_noi
-            todo_news       = list( set( todo_news ) - set( done_news ) )
-
-    for n in todo_news:
-        if cnfg.VERBOSE:
-            i_mode      = "img + txt" if with_img else "only text"
-            print( f"====> Processing news {n} {i_mode} <====" )
-
-        # note that cnfg.interface is not enough to instruct prompt formation, several models
-        # have different prompt formats even if under the same cnfg.interface
-        if "Qwen" in cnfg.model:
-            interface       = "qwen"
-        elif "gemma" in cnfg.model:
-            interface       = "gemma"
-        else:
-            interface       = cnfg.interface
-
-        pr, name        = prmpt.format_prompt(
-                            n,
-                            interface,
-                            mode        = cnfg.mode,
-                            pre         = cnfg.dialogs_pre,
-                            post        = cnfg.dialogs_post,
-                            with_img    = with_img,
-                            source      = cnfg.info_source,
-                            more        = cnfg.info_more,
-                            demographics= demographics,
-        )
-
-        # using OpenAI
-        if cnfg.interface == "openai":
-            completion  = cmplt.do_complete( pr )
-            pr          = prmpt.prune_prompt( pr ) # remove the textual version of the image from the prompt
-        # using HuggingFace
-        else:
-            image       = prmpt.image_pil( n ) if with_img else None
+    # local models are bound to the GPU, there is no gain in concurrent requests
+    if cnfg.exec_mode == "async" and cnfg.interface != "hf":
+        return asyncio.run( ask_news_async(
+                    with_img        = with_img,
+                    demographics    = demographics,
+                    agreement       = agreement,
+                    backup          = backup
+        ) )
+
+    todo_news       = resume_news( with_img, backup )
+    interface       = news_interface()
+    prep_q          = queue.Queue( maxsize=cnfg.pipeline_depth )
+    score_q         = queue.Queue( maxsize=cnfg.pipeline_depth )
+    arm             = "img" if with_img else "noi"
+    prep_depth      = QueueDepth( f"prompts {arm}" )
+    score_depth     = QueueDepth( f"replies {arm}" )
+    errors          = []
+    stop            = threading.Event()     # set when the completion stage ends, also on errors
+
+    def offer( item ):
+        # put an item in the queue of prompts, unless the pipeline is stopped while waiting
+        while not stop.is_set():
+            try:
+                prep_q.put( item, timeout=poll_stop )
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for n in todo_news:
+                if not offer( prepare_news( n, with_img, interface, demographics=demographics ) ):
+                    return
+        except Exception as e:
+            errors.append( e )
+        offer( None )
+
+    def consume():
+        while True:
+            item    = score_q.get()
+            if item is None:
+                return
+            score_depth.sample( score_q.qsize() )
+            if errors:
+                continue                # keep draining the queue, so the completion stage is not blocked
+            try:
+                score_news( item, with_img, agreement=agreement )
+            except Exception as e:
+                errors.append( e )
+
+    producer        = threading.Thread( target=produce, daemon=True )
+    scorer          = threading.Thread( target=consume, daemon=True )
+    producer.start()
+    scorer.start()
+    try:
+        while not errors:
+            item    = prep_q.get()
+            if item is None:
+                break
+            prep_depth.sample( prep_q.qsize() )
+            n, pr, name, image, t_start = item
             completion  = cmplt.do_complete( pr, image=image )
+            score_q.put( ( n, pr, name, completion, t_start ) )
+    finally:
+        stop.set()
+        producer.join()
+        score_q.put( None )
+        scorer.join()
+    if errors:
+        raise errors[ 0 ]
 
-        res             = check_reply( completion, agreement=agreement )
-        scores[ n ]     = res
-        prompts.append( pr )
-        completions.append( completion )
-        img_names.append( name )
-        done_news.append( n )
+    prep_depth.report()
+    score_depth.report()
+    return collect_news( with_img )
 
-        if with_img:
-            back_img    = prompts, completions, scores, img_names, done_news
-            save_backup( back_noi, back_img )
-        else:
-            back_noi    = prompts, completions, scores, img_names, done_news
-            save_backup( back_noi, None )
 
-    return prompts, completions, scores, img_names
+async def ask_news_async( with_img=True, demographics=None, agreement=False, backup=(None,None), in_flight=None ):
+    """
+    Prepare the prompts and obtain the model completions, keeping up to cnfg.n_concurrent news
+    in flight with the asynchronous clients of complete.py.
+    The stages of the pipeline are the same of ask_news(), with the preparation of prompts in a thread,
+    and cnfg.n_concurrent tasks for the completions.
+    The returned structures are the same, and in the same order, of ask_news().
+    When a completion or a score fails, the preparation and the completions still pending are cancelled.
+
+    params:
+        with_img    [bool] whether the prompts include image and text
+        demographics[dict] demographic details, or None
+        agreement   [bool] include the agreement score
+        backup      [tuple] possible previous backed data, with no-image first, and with-image second
+        in_flight   [asyncio.Semaphore] limit shared with other calls in the same event loop, or None
+
+    return:
+        [tuple] of:
+                    prompts     [list] of all prompt conversations
+                    completions [list] the list of completions
+                    scores      [list] of the yes/not answers
+    """
+    todo_news       = resume_news( with_img, backup )
+    interface       = news_interface()
+    if in_flight is None:
+        cmplt.reset_async()         # the asynchronous client is bound to the event loop, get a new one
+        in_flight       = asyncio.Semaphore( aimd.max_in_flight() )
+    prep_q          = asyncio.Queue( maxsize=cnfg.pipeline_depth )
+    score_q         = asyncio.Queue( maxsize=cnfg.pipeline_depth )
+    arm             = "img" if with_img else "noi"
+    prep_depth      = QueueDepth( f"prompts {arm}" )
+    score_depth     = QueueDepth( f"replies {arm}" )
+    n_workers       = min( aimd.max_in_flight(), max( 1, len( todo_news ) ) )
+    errors          = []
+
+    async def produce():
+        for n in todo_news:
+            item    = await asyncio.to_thread( prepare_news, n, with_img, interface, demographics )
+            await prep_q.put( item )
+        for i in range( n_workers ):
+            await prep_q.put( None )
+
+    async def complete():
+        while True:
+            item    = await prep_q.get()
+            if item is None:
+                return
+            prep_depth.sample( prep_q.qsize() )
+            n, pr, name, _, t_start = item
+            async with in_flight:
+                completion  = await cmplt.ado_complete( pr )
+            await score_q.put( ( n, pr, name, completion, t_start ) )
+
+    async def consume():
+        while True:
+            item    = await score_q.get()
+            if item is None:
+                return
+            score_depth.sample( score_q.qsize() )
+            if errors:
+                continue                # keep draining the queue, so the completion tasks are not blocked
+            try:
+                # there is no await in score_news(), so the records of the stream cannot interleave
+                score_news( item, with_img, agreement=agreement )
+            except Exception as e:
+                errors.append( e )
+                halt()
+
+    def halt():
+        # stop preparing prompts and sending requests, their replies would be discarded
+        for t in tasks:
+            t.cancel()
+
+    scorer          = asyncio.create_task( consume() )
+    tasks           = [ asyncio.create_task( produce() ) ] + \
+                      [ asyncio.create_task( complete() ) for i in range( n_workers ) ]
+    try:
+        await asyncio.wait( tasks, return_when=asyncio.FIRST_EXCEPTION )
+        halt()                          # after a failed completion, if any
+        await asyncio.gather( *tasks, return_exceptions=True )
+        errors  += [ t.exception() for t in tasks if not t.cancelled() and t.exception() is not None ]
+        await score_q.put( None )
+        await scorer
+    finally:
+        halt()
+        scorer.cancel()
+    if errors:
+        raise errors[ 0 ]
+
+    prep_depth.report()
+    score_depth.report()
+    return collect_news( with_img )
+
+
+def ask_both( demographics=None, agreement=False, backup=(None,None) ):
+    """
+    Prepare the prompts and obtain the model completions for news without and with image.
+    In async mode the two arms are independent and run together, under the same cnfg.n_concurrent limit,
+    otherwise the no-image arm is executed first.
+
+    params:
+        demographics[dict] demographic details, or None
+        agreement   [bool] include the agreement score
+        backup      [tuple] possible previous backed data, with no-image first, and with-image second
+
+    return:
+        [tuple] of the no-image and the with-image results of ask_news()
+    """
+    if cnfg.exec_mode == "async" and cnfg.interface != "hf":
+        return asyncio.run( ask_both_async(
+                    demographics    = demographics,
+                    agreement       = agreement,
+                    backup          = backup
+        ) )
+
+    res_noi         = ask_news( with_img=False, demographics=demographics, agreement=agreement, backup=backup )
+    res_img         = ask_news( with_img=True, demographics=demographics, agreement=agreement, backup=backup )
+    return res_noi, res_img
+
+
+async def ask_both_async( demographics=None, agreement=False, backup=(None,None) ):
+    """
+    Run the no-image and the with-image arms of ask_news_async() in the same event loop,
+    sharing the limit of news in flight
+
+    params:
+        demographics[dict] demographic details, or None
+        agreement   [bool] include the agreement score
+        backup      [tuple] possible previous backed data, with no-image first, and with-image second
+
+    return:
+        [tuple] of the no-image and the with-image results of ask_news()
+    """
+    cmplt.reset_async()
+    in_flight       = asyncio.Semaphore( aimd.max_in_flight() )
+    arms            = [ ask_news_async(
+                            with_img        = with_img,
+                            demographics    = demographics,
+                            agreement       = agreement,
+                            backup          = backup,
+                            in_flight       = in_flight
+                        ) for with_img in ( False, True ) ]
+    arms            = [ asyncio.create_task( a ) for a in arms ]
+    try:
+        res_noi, res_img    = await asyncio.gather( *arms )
+    except BaseException:
+        for a in arms:
+            a.cancel()                  # a failed arm stops the other, its replies would be discarded
+        await asyncio.gather( *arms, return_exceptions=True )
+        raise
+    return res_noi, res_img
 
 
 def check_news_text():
@@ -0,0 +1,90 @@
+"""
+#####################################################################################################################
+
+    Module to hedge slow requests to remote models
+
+    The latency of the requests is measured for each model. When a request takes longer than the
+    cnfg.hedge_percentile of the recent latencies, a duplicate request is sent, the first response
+    is used, and the other request is cancelled. At most cnfg.hedge_max requests are duplicated in a run.
+
+#####################################################################################################################
+"""
+
+import  threading
+import  collections
+import  numpy           as np
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+
+window                  = 500                   # number of recent latencies kept for each model
+min_samples             = 20                    # latencies needed before hedging
+latencies               = dict()                # recent latencies per ( interface, model )
+n_hedges                = 0                     # hedged requests in the current run
+lock                    = threading.Lock()      # guard for latencies and counter updated from threads
+
+
+# ===================================================================================================================
+#
+#   - reset
+#   - record
+#   - threshold
+#   - take
+#
+# ===================================================================================================================
+
+def reset():
+    """
+    Reset the count of hedged requests, at the beginning of a run
+    """
+    global n_hedges
+    with lock:
+        n_hedges    = 0
+
+
+def record( interface, model, seconds ):
+    """
+    Add the latency of a successful request
+
+    params:
+        interface   [str] the interface of the model
+        model       [str] the model name
+        seconds     [float] latency of the request
+    """
+    with lock:
+        key     = ( interface, model )
+        if key not in latencies:
+            latencies[ key ]    = collections.deque( maxlen=window )
+        latencies[ key ].append( seconds )
+
+
+def threshold( interface, model ):
+    """
+    Return the latency after which a request should be hedged
+
+    params:
+        interface   [str] the interface of the model
+        model       [str] the model name
+
+    return:         [float] seconds, or None if hedging is disabled or there are too few latencies
+    """
+    if cnfg.hedge_percentile is None:
+        return None
+    with lock:
+        lat     = latencies.get( ( interface, model ), () )
+        if len( lat ) < min_samples or n_hedges >= cnfg.hedge_max:
+            return None
+        return float( np.percentile( lat, cnfg.hedge_percentile ) )
+
+
+def take():
+    """
+    Account for a new hedged request, if still allowed in the run
+
+    return:         [bool] True if the request can be hedged
+    """
+    global n_hedges
+    with lock:
+        if n_hedges >= cnfg.hedge_max:
+            return False
+        n_hedges    += 1
+        return True
@@ -0,0 +1,401 @@
+"""
+#####################################################################################################################
+
+    Module to cache the images sent to remote models
+
+    The images are kept ready to send, as b64encoded strings, in two layers: an in-process LRU of the most
+    recent images, and a store on disk with the image file of each variant, named after the hash of the
+    content of the original image file. The hash of a file is computed once,
+    and again only if the file is modified.
+    The blank image inserted in text only prompts is also computed once.
+
+    Each image is prepared in variants for the targets of the requests, scaled down as the provider
+    would do anyway, so that fewer bytes are sent and no resizing is done at each request:
+
+        "orig"          the original file
+        "hf"            the original file, resized to 672x672 in memory for the local HuggingFace models
+        "openai_high"   within 2048x2048 and with the short side at most 768, as OpenAI detail "high"
+        "openai_low"    within 512x512, as OpenAI detail "low"
+        "anthro"        long edge at most 1568 and at most 1.15 megapixels, as recommended by anthropic
+
+    Each variant carries its size, its media type, and an estimate of the tokens of the image for the
+    remote targets.
+
+    The prompts carry handles of the images instead of their b64encoded content, like
+
+        imgref:<digest>:<target>:<file>
+
+    which are resolved to the images only when the requests are sent, with resolve(). Logs, backups and
+    results keep the handles.
+
+#####################################################################################################################
+"""
+
+import  os
+import  base64
+import  hashlib
+import  math
+import  threading
+import  collections
+from    io          import BytesIO
+from    PIL         import Image
+
+dir_store               = "../data/.imgcache"   # folder of the images stored on disk
+lru_size                = 512                   # images kept in memory
+jpeg_quality            = 90                    # quality of the scaled down JPEG variants
+hf_res                  = ( 672, 672 )          # resolution of the "hf" variant, see complete.native_res
+targets                 = ( "orig", "hf", "openai_high", "openai_low", "anthro" )
+
+lru                     = collections.OrderedDict() # ( digest, variant ) -> Payload, most recent last
+digests                 = dict()                # ( file, mtime, size ) -> digest of its content
+lock                    = threading.Lock()      # guard for the LRU and the digests, used from threads
+
+Payload                 = collections.namedtuple( "Payload", [ "b64", "size", "tokens", "media" ] )
+ref_prefix              = "imgref:"             # prefix of the handles of images in prompts
+
+
+# ===================================================================================================================
+#
+#   - fit_size
+#   - stored_target
+#   - estimate_tokens
+#   - transform
+#   - file_digest
+#   - lru_get
+#   - lru_put
+#   - load
+#   - variant
+#   - payload
+#   - image
+#   - blank
+#
+# ===================================================================================================================
+
+def fit_size( size, target ):
+    """
+    Return the size of an image scaled down for a target
+
+    params:
+        size        [tuple] width and height of the original image
+        target      [str] one of targets
+
+    return:         [tuple] width and height of the variant
+    """
+    w, h    = size
+    match target:
+        case "orig":
+            return size
+        case "hf":
+            return hf_res
+        case "openai_high":
+            scale   = min( 1., 2048 / max( w, h ) )
+            scale   *= min( 1., 768 / ( min( w, h ) * scale ) )
+        case "openai_low":
+            scale   = min( 1., 512 / max( w, h ) )
+        case "anthro":
+            scale   = min( 1., 1568 / max( w, h ), math.sqrt( 1.15e6 / ( w * h ) ) )
+        case _:
+            raise ValueError( f"image target '{target}' not supported" )
+    return max( 1, round( w * scale ) ), max( 1, round( h * scale ) )
+
+
+def stored_target( target ):
+    """
+    Return the variant stored for a target, the "hf" images are the original files resized when opened
+
+    params:
+        target      [str] one of targets
+
+    return:         [str]
+    """
+    return "orig" if target == "hf" else target
+
+
+def estimate_tokens( size, target ):
+    """
+    Return the estimated tokens of an image sent to a remote target, following the documentation of the providers
+
+    params:
+        size        [tuple] width and height of the image, as sent
+        target      [str] one of targets
+
+    return:         [int] or None for targets without estimate
+    """
+    w, h    = size
+    match target:
+        case "openai_high":
+            return 85 + 170 * math.ceil( w / 512 ) * math.ceil( h / 512 )
+        case "openai_low":
+            return 85
+        case "anthro":
+            return math.ceil( w * h / 750 )
+    return None
+
+
+def transform( raw, target ):
+    """
+    Produce the variant of an image for a target. The original bytes are kept for JPEG images not scaled down
+
+    params:
+        raw         [bytes] the original image file
+        target      [str] one of targets
+
+    return:         [bytes] the image file of the variant
+    """
+    image   = Image.open( BytesIO( raw ) )
+    size    = fit_size( image.size, target )
+    if size == image.size and image.format == "JPEG":
+        return raw
+    if image.mode not in ( "RGB", "L" ):
+        image   = image.convert( "RGB" )
+    if size != image.size:
+        image   = image.resize( size, Image.LANCZOS )
+    buffer  = BytesIO()
+    image.save( buffer, format="JPEG", quality=jpeg_quality )
+    return buffer.getvalue()
+
+
+def file_digest( fname ):
+    """
+    Return the hash of the content of a file, computed again only if the file is modified
+
+    params:
+        fname       [str] the file, with path
+
+    return:         [str] hexadecimal sha256 digest
+    """
+    st      = os.stat( fname )
+    key     = ( os.path.abspath( fname ), st.st_mtime_ns, st.st_size )
+    with lock:
+        if key in digests:
+            return digests[ key ]
+    with open( fname, 'rb' ) as f:
+        d       = hashlib.sha256( f.read() ).hexdigest()
+    with lock:
+        digests[ key ]  = d
+    return d
+
+
+def lru_get( key ):
+    """
+    params:
+        key         [tuple] digest and variant of the image
+
+    return:         [Payload] or None if not in memory
+    """
+    with lock:
+        if key not in lru:
+            return None
+        lru.move_to_end( key )
+        return lru[ key ]
+
+
+def lru_put( key, value ):
+    """
+    params:
+        key         [tuple] digest and variant of the image
+        value       [Payload]
+    """
+    with lock:
+        lru[ key ]  = value
+        lru.move_to_end( key )
+        while len( lru ) > lru_size:
+            lru.popitem( last=False )
+
+
+def load( key, make ):
+    """
+    Return an image from memory, or from disk, or produced by make() and then stored
+
+    params:
+        key         [tuple] digest and variant of the image
+        make        [function] with no arguments returning the raw bytes of the image
+
+    return:         [Payload]
+    """
+    value   = lru_get( key )
+    if value is not None:
+        return value
+
+    fname   = os.path.join( dir_store, "{}_{}.img".format( *key ) )
+    if os.path.isfile( fname ):
+        with open( fname, 'rb' ) as f:
+            raw     = f.read()
+    else:
+        raw     = make()
+        os.makedirs( dir_store, exist_ok=True )
+        tmp     = f"{fname}.{os.getpid()}.{threading.get_ident()}"
+        with open( tmp, 'wb' ) as f:
+            f.write( raw )
+        os.replace( tmp, fname )                    # atomic, concurrent processes may write the same image
+    b64     = base64.b64encode( raw ).decode( "utf-8" )
+
+    image   = Image.open( BytesIO( raw ) )          # reads just the header
+    media   = Image.MIME.get( image.format, "image/jpeg" )
+    value   = Payload( b64, image.size, estimate_tokens( image.size, key[ 1 ] ), media )
+    lru_put( key, value )
+    return value
+
+
+def variant( fname, target="orig" ):
+    """
+    Return the variant of an image file for a target, ready to send
+
+    params:
+        fname       [str] the image file, with path
+        target      [str] one of targets
+
+    return:         [Payload]
+    """
+    target  = stored_target( target )
+
+    def make():
+        with open( fname, 'rb' ) as f:
+            raw     = f.read()
+        return raw if target == "orig" else transform( raw, target )
+
+    return load( ( file_digest( fname ), target ), make )
+
+
+def payload( fname ):
+    """
+    Return an image file ready to send, as it is
+
+    params:
+        fname       [str] the image file, with path
+
+    return:         [Payload]
+    """
+    return variant( fname, "orig" )
+
+
+def image( fname, target="orig" ):
+    """
+    Return the variant of an image file for a target as PIL object, resized in memory for "hf"
+
+    params:
+        fname       [str] the image file, with path
+        target      [str] one of targets
+
+    return:         [PIL.Image.Image]
+    """
+    image   = Image.open( BytesIO( base64.b64decode( variant( fname, target ).b64 ) ) )
+    return image.resize( hf_res ) if target == "hf" else image
+
+
+def blank( size ):
+    """
+    Return a black JPEG image ready to send
+
+    params:
+        size        [tuple] width and height of the image
+
+    return:         [Payload]
+    """
+    def make():
+        image       = Image.new( mode='L', size=size, color="black" )
+        buffer      = BytesIO()
+        image.save( buffer, format="JPEG" )
+        return buffer.getvalue()
+
+    return load( ( "blank", "{}x{}".format( *size ) ), make )
+
+
+# ===================================================================================================================
+#
+#   Handles of images in prompts
+#   - handle
+#   - blank_handle
+#   - is_handle
+#   - lookup
+#   - resolve
+#
+# ===================================================================================================================
+
+def handle( fname, target="orig", digest=None ):
+    """
+    Return the handle of the variant of an image file
+
+    params:
+        fname       [str] the image file, with path
+        target      [str] one of targets
+        digest      [str] digest of the file if already known, or None
+
+    return:         [str]
+    """
+    if digest is None:
+        digest  = file_digest( fname )
+    return f"{ref_prefix}{digest}:{target}:{fname}"
+
+
+def blank_handle( size ):
+    """
+    Return the handle of a black image
+
+    params:
+        size        [tuple] width and height of the image
+
+    return:         [str]
+    """
+    return "{}blank:{}x{}:".format( ref_prefix, *size )
+
+
+def is_handle( value ):
+    """
+    params:
+        value       any value in a prompt
+
+    return:         [bool] True if the value is the handle of an image
+    """
+    return isinstance( value, str ) and value.startswith( ref_prefix )
+
+
+def lookup( h ):
+    """
+    Return the image of a handle, from the cache, or from its file if not cached
+
+    params:
+        h           [str] the handle
+
+    return:         [Payload]
+    """
+    digest, target, fname   = h[ len( ref_prefix ) : ].split( ':', 2 )
+    if digest == "blank":
+        return blank( tuple( int( d ) for d in target.split( 'x' ) ) )
+    target  = stored_target( target )
+
+    def make():
+        assert file_digest( fname ) == digest, f"image {fname} modified since its handle was created"
+        with open( fname, 'rb' ) as f:
+            raw     = f.read()
+        return raw if target == "orig" else transform( raw, target )
+
+    return load( ( digest, target ), make )
+
+
+def resolve( prompt ):
+    """
+    Return a copy of the prompt with the handles replaced by the b64encoded images, as expected by the
+    OpenAI ("url" of "image_url") and anthropic ("data" of "source", with its "media_type") clients
+
+    params:
+        prompt      [str] or [list] or [dict] the prompt or a part of it
+
+    return:         the prompt with the same structure
+    """
+    if isinstance( prompt, list ):
+        return [ resolve( p ) for p in prompt ]
+    if isinstance( prompt, dict ):
+        r       = dict()
+        media   = None
+        for k, v in prompt.items():
+            if is_handle( v ):
+                img     = lookup( v )
+                media   = img.media
+                r[ k ]  = f"data:{media};base64,{img.b64}" if k == "url" else img.b64
+            else:
+                r[ k ]  = resolve( v )
+        if media is not None and "media_type" in r:
+            r[ "media_type" ]   = media
+        return r
+    return prompt
@@ -20,6 +20,7 @@ from    statsmodels.formula.api     import ols, mixedlm
 from    statsmodels.stats.anova     import anova_lm
 from    scipy.stats                 import wilcoxon, norm, shapiro, kstest
 from    models                      import models_short_name
+import  newsstore
 import  plot
 
 DO_NOTHING          = False                 # for interactive use
@@ -200,9 +201,7 @@ def read_tags():
     def_tag             = "unknown"
     news_tags           = dict()
     dfile               = os.path.join( dir_json, f_news )
-    with open( dfile, 'r' ) as f:
-        news            = json.load( f )
-    for n in news:
+    for n in newsstore.get_store( dfile ).records():
         t_dict      = {
             "tag1" : def_tag,
             "tag2" : def_tag,
@@ -17,24 +17,42 @@ class Config( object ):
     Several parameters can be given in the configuration file as well as with command line flags.
 
     Command line flags:
+    CACHE                   [str] use of the completion cache, overwrites cache_mode (DEFAULT=None)
+    COMPILE                 [bool] render all the prompts of the execution into bundle_file, and exit
     CONFIG                  [str] name of configuration file (without path nor extension) (DEFAULT=None)
     DEBUG                   [str] debug mode, for generic debugging in selected parts of the software
     MAXTOKENS               [int] maximum number of tokens (DEFAULT=None)
     MODEL                   [int] index in the list of possible models (DEFAULT=0)
     NRETURNS                [int] number of return sequences (DEFAULT=None)
-    RECOVER:                [bool] recover from a previous aborted execution
+    PLAN                    [bool] print the jobs of the sweep with the estimated requests, and exit
+    QUEUE                   [str] action on the queue of jobs shared among hosts: "fill", "work", "status"
+    RECOVER:                [str] run ID of a previous aborted execution to recover, "last" for the most recent
     VERBOSE                 [bool] write additional information
 
     Configuration file parameters:
     agreement               [bool] meause coherence among replies in Likert scale
+    aimd                    [bool] adapt the requests in flight to the overload of the provider (default=False, see aimd.py)
+    aimd_max                [int] maximum requests in flight of each interface with aimd (default=64)
+    base_url                [str] alternative endpoint of the remote API, like a local stand-in server (default=None)
+    batch_poll              [int] seconds between checks of the state of a batch job (default=60)
+    bundle_file             [str] file of the prompts compiled ahead of the execution (default=None, see bundle.py)
+    cache_mode              [str] use of the completion cache: "off" (default), "use", "refresh" (see cache.py)
+    cache_size              [int] maximum size in MB of the completion cache (default=1024)
     demographics            [dict] demographic data or None
     detail                  [str] detail parameter for OpenAI image handling: "high", "low", "auto"
     dialogs_pre             [list or str] dialog ids to instert before the news
     multi_dialogs_pre       [list] dialog ids to instert before the news, with multiple choice as [list] in one slot
     multi_demography        [dict] multiple demographic options specified with lists as values
+    multi_model             [list] model_id of the models to sweep
+    multi_experiment        [list] experiments to sweep
+    multi_sampling          [dict] values of temperature, top_p, max_tokens, n_returns to sweep, as lists
     dialogs_post            [list or str] dialog ids to instert after the news
+    exec_mode               [str] execution of completions: "serial" (default), "async" or "batch"
     experiment              [str] mode of the experiment:  "news_noimage", "news_image", "both", "check_news"
     f_dialog                [str] filename of json file with dialogs
+    fanout_models           [list] model_id of models executed at the same time on prompts rendered once (see main_exec.py)
+    hedge_max               [int] maximum number of hedged requests in a run (default=50)
+    hedge_percentile        [float] percentile of latency after which a request is hedged, or None (default, see hedge.py)
     f_demo                  [str] filename of json file with demographics
     f_news                  [str] filename of json file with the news
     info_source             [bool] add info about the source of the news
@@ -45,7 +63,20 @@ class Config( object ):
     n_returns               [int] number of return sequences (overwritten by NRETURNS)
     news_ids                [list] ids of news to process
     news_amount             [int] number of news to process
+    queue_attempts          [int] maximum number of attempts of a job of the queue (default=3)
+    queue_file              [str] SQLite file with the queue of jobs, on a shared filesystem (see workq.py)
+    queue_lease             [int] seconds of lease of a job of the queue, renewed while executed (default=300)
+    queue_shards            [int] number of shards of the news for each job added to the queue (default=1)
+    n_concurrent            [int] number of news in flight with exec_mode "async" (default=8)
+    n_fanout                [int] number of concurrent samples for models with one return per request (default=10)
+    pipeline_depth          [int] maximum news waiting between the stages of the pipeline of ask_news() (default=4)
+    rate_limits             [dict] limits per minute of remote models, keyed by model or interface (see ratelimit.py)
+    rate_margin             [float] fraction of the rate limits to use (default=0.9)
     repetition_penalty      [float] penality for text repetitions in completion
+    retry_budget            [int] maximum number of retries of remote requests in a run (default=500)
+    retry_max               [int] maximum number of attempts of a remote request (default=8)
+    sweep_limits            [dict] maximum runs in parallel for each interface, in a sweep (see sweep.py)
+    sweep_workers           [int] number of processes executing the runs of a sweep (default=1)
     top_p                   [int] probability mass of tokens generated in completion (default=1)
     temperature             [float] sampling temperature during completion (default=1.0)
 
@@ -107,6 +138,52 @@ class Config( object ):
             self.likert_scale       = False     # Default is to use YES/NO for model replies
         if not hasattr( self, 'agreement' ):
             self.agreement          = False     # set no agreement measure for Likert scale
+        if not hasattr( self, 'exec_mode' ):
+            self.exec_mode          = "serial"  # one news at a time
+        if not hasattr( self, 'n_concurrent' ):
+            self.n_concurrent       = 8         # news in flight with exec_mode "async"
+        if not hasattr( self, 'n_fanout' ):
+            self.n_fanout           = 10        # concurrent samples for anthropic models
+        if not hasattr( self, 'aimd' ):
+            self.aimd               = False     # fixed number of requests in flight
+        if not hasattr( self, 'aimd_max' ):
+            self.aimd_max           = 64        # requests in flight of each interface with aimd
+        if not hasattr( self, 'hedge_percentile' ):
+            self.hedge_percentile   = None      # no hedging of slow requests
+        if not hasattr( self, 'hedge_max' ):
+            self.hedge_max          = 50        # hedged requests in a run
+        if not hasattr( self, 'pipeline_depth' ):
+            self.pipeline_depth     = 4         # prompts prepared ahead of the completions
+        if not hasattr( self, 'rate_limits' ):
+            self.rate_limits        = dict()    # no pacing of requests
+        if not hasattr( self, 'rate_margin' ):
+            self.rate_margin        = 0.9       # keep just under the rate limits
+        if not hasattr( self, 'retry_max' ):
+            self.retry_max          = 8         # attempts of a remote request on transient errors
+        if not hasattr( self, 'retry_budget' ):
+            self.retry_budget       = 500       # retries of remote requests in a run
+        if not hasattr( self, 'base_url' ):
+            self.base_url           = None      # use the default endpoint of the provider
+        if not hasattr( self, 'batch_poll' ):
+            self.batch_poll         = 60        # seconds between checks of batch jobs
+        if not hasattr( self, 'cache_mode' ):
+            self.cache_mode         = "off"     # completions are always requested to the model
+        if not hasattr( self, 'bundle_file' ):
+            self.bundle_file        = None      # prompts composed during the execution
+        if not hasattr( self, 'cache_size' ):
+            self.cache_size         = 1024      # MB of cached completions
+        if not hasattr( self, 'sweep_workers' ):
+            self.sweep_workers      = 1         # runs of a sweep one after the other
+        if not hasattr( self, 'sweep_limits' ):
+            self.sweep_limits       = dict()    # runs in parallel limited only by sweep_workers
+        if not hasattr( self, 'queue_file' ):
+            self.queue_file         = "../data/queue.db"
+        if not hasattr( self, 'queue_lease' ):
+            self.queue_lease        = 300       # seconds before a job of a crashed worker is taken by others
+        if not hasattr( self, 'queue_attempts' ):
+            self.queue_attempts     = 3         # attempts of a job before giving up
+        if not hasattr( self, 'queue_shards' ):
+            self.queue_shards       = 1         # each job processes all news
 
 
 
@@ -139,6 +216,16 @@ def read_args():
     """
     parser      = ArgumentParser()
 
+    parser.add_argument(
+            '-C',
+            '--cache',
+            action          = 'store',
+            dest            = 'CACHE',
+            type            = str,
+            choices         = [ "off", "use", "refresh" ],
+            default         = None,
+            help            = "use of the completion cache: off, use, refresh (default from configuration)"
+    )
     parser.add_argument(
             '-c',
             '--config',
@@ -155,6 +242,13 @@ def read_args():
             dest            = 'DEBUG',
             help            = "debug mode: print prompts only, do not call LLMs"
     )
+    parser.add_argument(
+            '-k',
+            '--compile',
+            action          = 'store_true',
+            dest            = 'COMPILE',
+            help            = "render all the prompts of the execution into the bundle file, and exit"
+    )
     parser.add_argument(
             '-m',
             '--model',
@@ -182,12 +276,32 @@ def read_args():
             default         = None,
             help            = "number of return sequences (default=1)",
     )
+    parser.add_argument(
+            '-p',
+            '--plan',
+            action          = 'store_true',
+            dest            = 'PLAN',
+            help            = "print the jobs of the sweep with the estimated requests, and exit"
+    )
+    parser.add_argument(
+            '-Q',
+            '--queue',
+            action          = 'store',
+            dest            = 'QUEUE',
+            type            = str,
+            choices         = [ "fill", "work", "status" ],
+            default         = None,
+            help            = "add jobs to the shared queue, execute them, or show their state"
+    )
     parser.add_argument(
             '-r',
             '--recover',
-            action          = 'store_true',
+            action          = 'store',
             dest            = 'RECOVER',
-            help            = "recover from the previous failed execution"
+            nargs           = '?',
+            const           = "last",
+            default         = None,
+            help            = "recover the failed execution with the given run ID (default the last one)"
     )
     parser.add_argument(
             '-v',
@@ -13,7 +13,7 @@ import  os
 import  sys
 import  copy
 import  shutil
-import  itertools
+import  functools
 import  time
 import  numpy           as np
 
@@ -21,7 +21,15 @@ import  load_cnfg                               # this module sets program param
 import  prompt          as prmpt                # this module composes the prompts
 import  complete        as cmplt                # this module performs LLM completions
 import  conversation    as conv                 # this module handles conversations with the LLM
+import  ratelimit                               # this module paces requests under the rate limits
+import  hedge                                   # this module hedges slow requests
+import  aimd                                    # this module adapts the requests in flight
+import  batch                                   # this module executes experiments with batch APIs
+import  cache                                   # this module caches completions across executions
+import  sweep                                   # this module plans sweeps of multiple executions
+import  workq                                   # this module shares the jobs of a sweep among hosts
 import  save_res                                # this module saves results
+import  bundle                                  # this module compiles the prompts ahead of execution
 
 # this module lists the available LLMs
 from    models          import models, models_endpoint, models_interface
@@ -32,7 +40,12 @@ DO_NOTHING              = False                 # for interactive usage
 frmt_response           = "%y-%m-%d_%H-%M-%S"   # datetime format for filenames
 dir_res                 = '../res'              # folder of results
 dir_json                = '../data'             # folder of json data
-back_file               = "../data/.back.pkl"   # file with temporary backup
+batch_interfaces        = ( "openai", "anthro" ) # interfaces supporting exec_mode "batch"
+batch_arms              = {                     # with_img of the modalities of each experiment in a batch job
+        "news_noimage"      : [ False ],
+        "news_image"        : [ True ],
+        "both"              : [ False, True ],
+}
 
 cnfg                    = None                  # object containing the execution configuration (see load_cnfg.py)
 
@@ -44,48 +57,127 @@ exec_data               = None
 exec_log                = None
 exec_pkl                = None
 exec_csv                = None
+exec_usage              = None
+exec_limits             = None
 base_exec_src           = 'src'
 base_exec_data          = 'data'
 base_exec_log           = 'log.txt'
 base_exec_pkl           = 'res.pkl'
 base_exec_csv           = 'res.csv'
+base_exec_usage         = 'usage.csv'
+base_exec_limits        = 'concurrency.csv'
+base_exec_jsonl         = 'res.jsonl'           # stream of results of each news, also used as backup
+base_exec_batch         = '.batch.json'         # state of batch jobs
+base_exec_requests      = '.batch_{}.jsonl'     # requests of batch jobs
 
 
 # ===================================================================================================================
 #
 #   Utilities to set up execution
+#   - find_run
 #   - init_dirs
+#   - set_model
 #   - init_cnfg
+#   - export_cnfg
 #   - archive
+#   - prompt_variant
+#   - current_bundle
+#   - load_bundle
+#   - parallel_runs
 #
 # ===================================================================================================================
 
+def find_run( run_id ):
+    """
+    Return the folder of a previous execution to recover
+
+    params:
+        run_id      [str] name of the folder in dir_res, or "last" for the most recent execution not completed
+
+    return:         [str] the folder of the execution
+    """
+    if run_id != "last":
+        run_dir     = os.path.join( dir_res, run_id )
+        assert os.path.isdir( run_dir ), f"can't recover execution: run {run_id} not found"
+        return run_dir
+
+    checkpoint  = base_exec_batch if cnfg.exec_mode == "batch" else base_exec_jsonl
+    for run_id in sorted( os.listdir( dir_res ), reverse=True ):
+        run_dir     = os.path.join( dir_res, run_id )
+        if os.path.isfile( os.path.join( run_dir, checkpoint ) ) and \
+                not os.path.isfile( os.path.join( run_dir, base_exec_pkl ) ):
+            return run_dir
+    assert False, "can't recover execution: no interrupted run found"
+
+
 def init_dirs():
     """
-    Set paths and create directories where to save the current execution
+    Set paths and create directories where to save the current execution.
+    The name of the folder, that is the run ID, is the current time, with a suffix if other executions
+    started in the same second. When recovering, the folder of the previous execution is used.
     """
     global exec_dir, exec_src, exec_data        # dirs
     global exec_log, exec_pkl, exec_csv         # files
+    global exec_usage, exec_limits
 
-    now_time        = time.strftime( frmt_response )        # string used for composing file names of results
-    exec_dir        = os.path.join( dir_res, now_time )
-    while os.path.isdir( exec_dir ):
+    if cnfg.RECOVER:
+        exec_dir        = find_run( cnfg.RECOVER )
         if cnfg.VERBOSE:
-            print( f"WARNING: a folder with the timestamp {exec_dir} already exists." )
-            print( "Creating a folder with a timestamp a second ahead.\n" )
-        sec         = int( exec_dir[ -2: ] )
-        sec         += 1
-        exec_dir    = f"{exec_dir[ :-2 ]}{sec:02d}"
+            print( f"recovering execution {exec_dir}\n" )
+    else:
+        now_time        = time.strftime( frmt_response )    # string used for composing file names of results
+        exec_dir        = os.path.join( dir_res, now_time )
+        suffix          = 0
+        while True:
+            try:
+                os.mkdir( exec_dir )                        # fails if another run has already taken the folder
+                break
+            except FileExistsError:
+                suffix      += 1
+                exec_dir    = os.path.join( dir_res, f"{now_time}_{suffix}" )
 
     exec_src        = os.path.join( exec_dir, base_exec_src )
     exec_data       = os.path.join( exec_dir, base_exec_data )
 
-    os.makedirs( exec_dir )
-    os.makedirs( exec_src )
-    os.makedirs( exec_data )
+    os.makedirs( exec_src, exist_ok=True )
+    os.makedirs( exec_data, exist_ok=True )
     exec_log        = os.path.join( exec_dir, base_exec_log )
     exec_pkl        = os.path.join( exec_dir, base_exec_pkl )
     exec_csv        = os.path.join( exec_dir, base_exec_csv )
+    exec_usage      = os.path.join( exec_dir, base_exec_usage )
+    exec_limits     = os.path.join( exec_dir, base_exec_limits )
+
+    # the recovery state is private to the execution
+    cnfg.stream_file    = os.path.join( exec_dir, base_exec_jsonl )
+    batch.state_file    = os.path.join( exec_dir, base_exec_batch )
+    batch.requests_file = os.path.join( exec_dir, base_exec_requests )
+    if cnfg.RECOVER:
+        checkpoint  = batch.state_file if cnfg.exec_mode == "batch" else cnfg.stream_file
+        assert os.path.isfile( checkpoint ), "can't recover execution: backup file not found"
+
+
+def set_model():
+    """
+    Derive from cnfg.model_id the complete model name, usage mode and interface,
+    and manage the possible directive, that follows the model name with a "+"
+    """
+    assert cnfg.model_id < len( models ), f"error: model # {cnfg.model_id} not available"
+    cnfg.model          = models[ cnfg.model_id ]
+    cnfg.mode           = models_endpoint[ cnfg.model ]
+    cnfg.interface      = models_interface[ cnfg.model ]
+    prmpt.insert_blank  = False
+    cmplt.client        = None                              # the client of a previous model cannot be reused
+    cmplt.reset_async()
+    if hasattr( cnfg, 'directive' ):
+        del cnfg.directive
+
+    if '+' in cnfg.model:
+        name, directive     = cnfg.model.split( '+' )
+        cnfg.model          = name                          # restore the proper name of the model
+        cnfg.directive      = directive                     # make the directive visible in log.txt
+        # now manage the directive
+        if directive == "blank_img":                        # include a blank image for text only news
+            prmpt.insert_blank  = True                      # inform the prompt module
 
 
 def init_cnfg():
@@ -134,55 +226,42 @@ def init_cnfg():
     if cnfg.MAXTOKENS is not None:      cnfg.max_tokens = cnfg.MAXTOKENS
     if cnfg.MODEL is not None:          cnfg.model_id   = cnfg.MODEL
     if cnfg.NRETURNS is not None:       cnfg.n_returns  = cnfg.NRETURNS
+    if cnfg.CACHE is not None:          cnfg.cache_mode = cnfg.CACHE
 
     if cnfg.experiment == "check_news":                     # when checking news just one completion is required
         cnfg.n_returns  = 1
         if not len( cnfg.dialogs_pre ):                     # set default dialog, if not already set in configuration
             cnfg.dialogs_pre    = "check_text"
 
-    # if a model is used, from its index derive the complete model name and usage mode
     if hasattr( cnfg, 'model_id' ):
-        assert cnfg.model_id < len( models ), f"error: model # {cnfg.model_id} not available"
-        cnfg.model          = models[ cnfg.model_id ]
-        cnfg.mode           = models_endpoint[ cnfg.model ]
-        cnfg.interface      = models_interface[ cnfg.model ]
-
-    # if a model is used, check if the name contains a directive, that follows the model name with a "+"
-    if hasattr( cnfg, 'model' ):
-        if '+' in cnfg.model:
-            name, directive     = cnfg.model.split( '+' )
-            cnfg.model          = name                      # restore the proper name of the model
-            cnfg.directive      = directive                 # make the directive visible in log.txt
-            # now manage the directive
-            if directive == "blank_img":                    # include a blank image for text only news
-                prmpt.insert_blank  = True                  # inform the prompt module
-
-    # this variabile in the configuration triggers multi-execution over multiple options in dialogs_pre
+        set_model()
+
+    # this variabile in the configuration triggers multi-execution over a grid of variations (see sweep.py)
     if hasattr( cnfg, 'multi_dialogs_pre' ):
         assert isinstance( cnfg.multi_dialogs_pre, list ), "error in configuration: multi_dialogs_pre is not a list"
-        assert not hasattr( cnfg, 'multi_demography' ), "error: cannot do multiple runs for dialogs_pre and demography"
-        cnfg.multi_exec = "dialogs_pre"
-    else:
-        cnfg.multi_exec = "single"
-
-    # this variabile in the configuration triggers multi-execution over multiple options in demographics
     if hasattr( cnfg, 'multi_demography' ):
         assert isinstance( cnfg.multi_demography, dict ), "error in configuration: multi_demography is not a dict"
-        cnfg.multi_exec = "demography"
 
-    # export information from config
-    if hasattr( cnfg, 'f_dialog' ):     prmpt.f_dialog  = cnfg.f_dialog
-    if hasattr( cnfg, 'f_demo' ):       prmpt.f_demo    = cnfg.f_demo
-    if hasattr( cnfg, 'detail' ):       prmpt.detail    = cnfg.detail
-    prmpt.f_news        = cnfg.f_news
+    export_cnfg()
+    if sweep.is_sweep():
+        cnfg.multi_exec = "sweep"
+    elif hasattr( cnfg, 'fanout_models' ):
+        cnfg.multi_exec = "fanout"
+        for i in cnfg.fanout_models:
+            assert i < len( models ), f"error: model # {i} not available"
+    else:
+        cnfg.multi_exec = "single"
 
     if not len( cnfg.news_ids ):
-        if cnfg.news_amount is None:
-            # use all news in file if not specified otherwise
-            cnfg.news_ids   = prmpt.list_news()
-        else:
+        if cnfg.news_amount is not None:
             # use the first N news in file
             cnfg.news_ids   = prmpt.list_news( cnfg.news_amount )
+        elif not cnfg.COMPILE and current_bundle() is not None:
+            # use the news compiled in the bundle
+            cnfg.news_ids   = list( bundle.load( cnfg.bundle_file ).news )
+        else:
+            # use all news in file if not specified otherwise
+            cnfg.news_ids   = prmpt.list_news()
 
     # verify backward compatibility of dialog titles
     if hasattr( cnfg, 'dialogs_pre' ):
@@ -210,17 +289,31 @@ def init_cnfg():
     if not hasattr( cnfg, 'agreement' ):
         cnfg.agreement          = False                     # set no agreement measure, if not set otherwise
 
-    if cnfg.RECOVER:                                        # manage recovery backup
-        assert os.path.isfile( back_file ), \
-            "can't recover execution: backup file not found"
-    else:
-        if os.path.exists( back_file ):
-            os.remove( back_file )
-    cnfg.back_file      = back_file
+    if cnfg.exec_mode == "batch":
+        assert cnfg.interface in batch_interfaces, \
+            f"error: batch execution not available for interface {cnfg.interface}"
+    assert not ( cnfg.RECOVER and cnfg.multi_exec in ( "sweep", "fanout" ) ), \
+        "error: a sweep cannot be recovered, recover its runs one by one"
+
+
+def export_cnfg():
+    """
+    Pass the configuration to the other modules
+    """
+    if hasattr( cnfg, 'f_dialog' ):     prmpt.f_dialog  = cnfg.f_dialog
+    if hasattr( cnfg, 'f_demo' ):       prmpt.f_demo    = cnfg.f_demo
+    if hasattr( cnfg, 'detail' ):       prmpt.detail    = cnfg.detail
+    prmpt.f_news        = cnfg.f_news
 
-    # pass global parameters to other modules
     cmplt.cnfg          = cnfg
     conv.cnfg           = cnfg
+    ratelimit.cnfg      = cnfg
+    hedge.cnfg          = cnfg
+    aimd.cnfg           = cnfg
+    batch.cnfg          = cnfg
+    cache.cnfg          = cnfg
+    sweep.cnfg          = cnfg
+    workq.cnfg          = cnfg
     save_res.cnfg       = cnfg
 
 
@@ -237,17 +330,28 @@ def archive():
     )
 
     pfiles  = [
+                "aimd.py",
+                "batch.py",
+                "bundle.py",
+                "cache.py",
                 "clean_data.py",
                 "complete.py",
                 "conversation.py",
+                "hedge.py",
+                "imgcache.py",
                 "infstat.py",
                 "load_cnfg.py",
                 "main_exec.py",
                 "models.py",
+                "newsstore.py",
                 "plot.py",
                 "prompt.py",
+                "ratelimit.py",
                 "save_res.py",
                 "scan_res.py",
+                "sweep.py",
+                "templates.py",
+                "workq.py",
     ]
 
     if cnfg.CONFIG is not None:
@@ -266,14 +370,105 @@ def archive():
             print( f"NOTE: no file named {jfile} to copy")
 
 
+def prompt_variant( job=None ):
+    """
+    Return the parameters of the prompts of the execution, or of a job of the sweep
+
+    params:
+        job         [dict] the configuration parameters of the job (see sweep.py), or None
+
+    return:         [dict] the arguments of prompt.render_segments() and bundle.variant_key()
+    """
+    job     = job or dict()
+    return {
+            "pre"           : job.get( "dialogs_pre", cnfg.dialogs_pre ),
+            "post"          : cnfg.dialogs_post,
+            "source"        : cnfg.info_source,
+            "more"          : cnfg.info_more,
+            "demographics"  : job.get( "demographics", cnfg.demographics ),
+    }
+
+
+def current_bundle():
+    """
+    Return the bundle in cnfg.bundle_file, if compiled from the current files of news and dialogs
+
+    return:         [bundle.Bundle] or None
+    """
+    if cnfg.bundle_file is None or not os.path.isfile( cnfg.bundle_file ):
+        return None
+    b       = bundle.load( cnfg.bundle_file )
+    stale   = b.stale( prmpt.source_files() )
+    if len( stale ):
+        print( f"WARNING: {cnfg.bundle_file} compiled from other versions of {', '.join( stale )}, not used" )
+        return None
+    return b
+
+
+def load_bundle():
+    """
+    Return the bundle of the prompts compiled in cnfg.bundle_file, if it has the prompts of the execution
+
+    return:         [bundle.Bundle] or None if the prompts are composed during the execution
+    """
+    b       = current_bundle()
+    if b is None:
+        return None
+    if b.has_variant( bundle.variant_key( **prompt_variant() ) ):
+        return b
+    print( f"WARNING: prompts of this execution not compiled in {cnfg.bundle_file}, composing them" )
+    return None
+
+
+def parallel_runs():
+    """
+    Return the number of runs that may be executing at the same time with the interface of the current model,
+    sharing its rate limits
+
+    return:         [int]
+    """
+    if cnfg.multi_exec == "fanout":
+        n_models    = sum( models_interface[ models[ i ] ] == cnfg.interface for i in cnfg.fanout_models )
+        return sweep.slots( cnfg.interface, n_workers=n_models )
+    return sweep.slots( cnfg.interface )
+
+
 # ===================================================================================================================
 #
 #   Main function
+#   - ask_batch
 #   - do_exec
-#   - multi_exec
+#   - run_job
+#   - multi_sweep
+#   - multi_fanout
+#   - queue_exec
+#   - compile_bundle
 #
 # ===================================================================================================================
 
+def ask_batch():
+    """
+    Obtain the completions of all modalities of the experiment with one batch job
+
+    return:     [tuple] prompts, completions, results and image names, as assembled in do_exec()
+    """
+    arms            = batch_arms[ cnfg.experiment ]
+    results         = batch.ask_news(
+            arms,
+            demographics    = cnfg.demographics,
+            agreement       = cnfg.agreement
+        )
+    if cnfg.experiment != "both":
+        return results[ 0 ]
+
+    ( pr_noi, com_noi, res_noi, n_n ), ( pr_img, com_img, res_img, n_i )    = results
+    pr              = pr_img + pr_noi
+    compl           = com_img + com_noi
+    names           = n_i + n_n
+    res             = { "with_img": res_img, "no_img": res_noi }
+    return pr, compl, res, names
+
+
 def do_exec():
     """
     Execute the program in one of the available modality (with image, without, or both) and save the results.
@@ -281,40 +476,33 @@ def do_exec():
     return:     True if execution is succesful
     """
     fstream         = open( exec_log, 'w', encoding="utf-8" )   # open the log file
+    cmplt.reset_stats()                                         # counters are reported in the log of each run
 
     match cnfg.experiment:
+        case "news_noimage" | "news_image" | "both" if cnfg.exec_mode == "batch":
+            pr, compl, res, names           = ask_batch()
+
         case "news_noimage":
             pr, compl, res, names           = conv.ask_news(
                     with_img        = False,
                     demographics    = cnfg.demographics,
-                    agreement       = cnfg.agreement
+                    agreement       = cnfg.agreement,
+                    backup          = conv.load_records() if cnfg.RECOVER else ( None, None )
                 )
 
         case "news_image":
             pr, compl, res, names           = conv.ask_news(
                     with_img        = True,
                     demographics    = cnfg.demographics,
-                    agreement       = cnfg.agreement
+                    agreement       = cnfg.agreement,
+                    backup          = conv.load_records() if cnfg.RECOVER else ( None, None )
                 )
 
         case "both":
-            back_noi                = None
-            back_img                = None
-            if cnfg.RECOVER:
-                back_noi, back_img  = conv.load_backup()
-            if back_img is None:
-                pr_noi, com_noi, res_noi, n_n   = conv.ask_news(
-                        with_img        = False,
-                        demographics    = cnfg.demographics,
-                        agreement       = cnfg.agreement,
-                        backup          = ( back_noi, False )
-                    )
-                back_noi                = pr_noi, com_noi, res_noi, n_n, copy.deepcopy( cnfg.news_ids )
-            pr_img, com_img, res_img, n_i   = conv.ask_news(
-                    with_img        = True,
+            ( pr_noi, com_noi, res_noi, n_n ), ( pr_img, com_img, res_img, n_i )  = conv.ask_both(
                     demographics    = cnfg.demographics,
                     agreement       = cnfg.agreement,
-                    backup          = ( back_noi, back_img )
+                    backup          = conv.load_records() if cnfg.RECOVER else ( None, None )
                 )
             pr                              = pr_img + pr_noi
             compl                           = com_img + com_noi
@@ -341,66 +529,158 @@ def do_exec():
             exec_pkl,
             mode        = cnfg.mode,
             likert      = cnfg.likert_scale,
-            agreement   = cnfg.agreement
+            agreement   = cnfg.agreement,
+            stats       = { **cmplt.stats, **aimd.summary() }
             )
+    save_res.write_usage( exec_usage, cmplt.usage )
+    if cnfg.aimd:
+        save_res.write_usage( exec_limits, aimd.history )
     fstream.close()
     return True
 
 
-def multi_dialogs_pre():
+def run_job( cfg, job, parallel=False, rendered=None ):
     """
-    Execute the program multiple times with variations in dialogs_pre
-    it is necessary to validate in the configuration file a list with name "multi_dialogs_pre"
-    that contains an arbitrary number of dialog turns, one of which is not a string with a dialog title
-    but another list, and all the titles inside it are used in an execution
-    if this list is empty, all the exixting options with title starting with "p_" will be used, see
-    list_profiles() in prompt.py
+    Execute one job of a sweep in its own folder of results, also in a worker process.
+    The job is applied to a copy of the configuration, that is left unchanged for the other jobs
+
+    params:
+        cfg         [load_cnfg.Config] the configuration of the sweep
+        job         [dict] the configuration parameters of the job (see sweep.py)
+        parallel    [bool] whether other runs may be executing at the same time
+        rendered    [dict] prompts already rendered by prompt.render_news(), or None to read them from
+                    cnfg.bundle_file, if compiled
+
+    return:         [str] the folder of results
     """
+    global cnfg
 
-    pre_var     = [ pre for pre in cnfg.multi_dialogs_pre if isinstance( pre, list ) ]
-    assert len( pre_var ) == 1, "ERROR: there should be only one multivariation in multi_dialogs_pre"
-    pre_var     = pre_var[ 0 ]
-    if not len( pre_var ):                                      # the empty list means use all possible options
-        pre_var = prmpt.list_profiles()                         # that are read from json file
-    n_pre       = len( cnfg.multi_dialogs_pre )                 # number of dialog turns
-    idx_var     = cnfg.multi_dialogs_pre.index( pre_var )       # index of the dialg turn with multiple options
-    n_pre_var   = len( pre_var )                                # number of options for the varied dialog turn
+    cnfg            = copy.deepcopy( cfg )
+    export_cnfg()
+    for key, value in job.items():
+        setattr( cnfg, key, value )
+    prmpt.rendered  = rendered if rendered is not None else load_bundle()
+    set_model()
+    if parallel:
+        cnfg.rate_margin    /= parallel_runs()                  # the rate limits are shared by the runs
+    init_dirs()                                                 # create a new folder for results
+    if not cnfg.DEBUG:
+        archive()                                               # archive the results
+    do_exec()
+    return exec_dir
+
+
+def multi_sweep():
+    """
+    Execute the program multiple times, for all the jobs of the sweep planned from the variations
+    in the configuration file (see sweep.py), in parallel processes if cnfg.sweep_workers > 1
+    """
+    jobs        = sweep.plan()
+    n_jobs      = len( jobs )
+    if cnfg.VERBOSE:
+        sweep.write_plan( sys.stdout, jobs )
+    if cnfg.DEBUG:
+        print( "Program running in DEBUG mode, not archiving" )
 
-    # generates on-the-fly cnfg.dialogs_pre with one option at turn
-    for i, option in enumerate( pre_var ):
-        if cnfg.VERBOSE:
-            print( f"\n** run {i+1} of {n_pre_var} multiple executions, using option {option} of dialogs_pre **\n" )
-        dialogs_pre             = copy.deepcopy( cnfg.multi_dialogs_pre )
-        dialogs_pre[ idx_var ]  = option
-        cnfg.dialogs_pre        = dialogs_pre                   # NOTE: no need to export cnfg again to cmplt
-        if i:                                                   # skip init_dirs() and archive() the first run
-            init_dirs()                                         # create a new folder for results
-            archive()                                           # archive the results
-        do_exec()                                               # execute the main program
-
-
-def multi_demography():
-    """
-    Execute the program multiple times with variations in demographics
-    it is necessary to validate in the configuration file a directory with name "multi_demography"
-    that contains for each key a list with an arbitrary number of options
-    """
-    # generates all combinations of the options listed for each demogaphics key
-    keys        = cnfg.multi_demography.keys()
-    values      = cnfg.multi_demography.values()
-    all_values  = itertools.product( *values )                  # cartesian product of all lists in multi_demography
-    demo_comb   = [ dict( zip(keys,v) ) for v in all_values ]   # all combinations
-    n_comb      = len( demo_comb )
-
-    # generates on-the-fly cnfg.demographics with one option at turn
-    for i, demo in enumerate( demo_comb ):
-        if cnfg.VERBOSE:
-            print( f"\n** run {i+1} of {n_comb} multiple executions with variations in demographics **\n" )
-        cnfg.demographics       = demo
-        if i:                                                   # skip init_dirs() and archive() the first run
-            init_dirs()                                         # create a new folder for results
-            archive()                                           # archive the results
-        do_exec()                                               # execute the main program
+    if cnfg.sweep_workers > 1:
+        sweep.execute( jobs, functools.partial( run_job, parallel=True ), cnfg )
+        return
+
+    base        = cnfg                                          # run_job() replaces cnfg with its own copy
+    for i, job in enumerate( jobs ):
+        if base.VERBOSE:
+            print( f"\n** run {i+1} of {n_jobs} multiple executions: {sweep.describe( job )} **\n" )
+        run_job( base, job )
+
+
+def multi_fanout():
+    """
+    Execute the experiment with all the models in cnfg.fanout_models at the same time, one process
+    for each model and one folder of results for each model.
+    The prompts are rendered once and shared by all models, each formatting them for its own interface,
+    and the images are prepared once in the variants for the interfaces.
+    Local HuggingFace models still run one at a time (see sweep.slots()), and the models of the same
+    interface share its rate limits.
+    When the prompts are compiled in cnfg.bundle_file, all the processes read them from the bundle.
+    """
+    rendered    = None
+    targets     = { prmpt.image_target( models_interface[ models[ i ] ] ) for i in cnfg.fanout_models } - { None }
+    if load_bundle() is None:
+        rendered    = dict()
+        for with_img in batch_arms.get( cnfg.experiment, [] ):
+            rendered.update( prmpt.render_news(
+                    cnfg.news_ids,
+                    with_img    = with_img,
+                    pre         = cnfg.dialogs_pre,
+                    post        = cnfg.dialogs_post,
+                    source      = cnfg.info_source,
+                    more        = cnfg.info_more,
+                    demographics= cnfg.demographics,
+                    targets     = targets,
+            ) )
+    jobs        = [ { "model_id": i } for i in cnfg.fanout_models ]
+    if cnfg.VERBOSE:
+        sweep.write_plan( sys.stdout, jobs )
+    if cnfg.DEBUG:
+        print( "Program running in DEBUG mode, not archiving" )
+    sweep.execute( jobs, functools.partial( run_job, parallel=True, rendered=rendered ), cnfg, n_workers=len( jobs ) )
+
+
+def queue_exec():
+    """
+    Manage the queue of jobs shared by workers on several hosts (see workq.py), according to cnfg.QUEUE:
+        "fill"      add the jobs of the sweep planned from the configuration file, split in news shards
+        "work"      execute jobs from the queue until there are no more available
+        "status"    show the state of the jobs
+    """
+    match cnfg.QUEUE:
+        case "fill":
+            jobs        = sweep.shard( sweep.plan() )
+            if cnfg.VERBOSE:
+                sweep.write_plan( sys.stdout, jobs )
+            n_added     = workq.fill( jobs, [ sweep.job_key( job ) for job in jobs ] )
+            print( f"{n_added} of {len( jobs )} jobs added to {cnfg.queue_file}" )
+        case "work":
+            base        = cnfg                                  # run_job() replaces cnfg with its own copy
+            n_done      = workq.work( lambda job: run_job( base, job, parallel=True ) )
+            print( f"{n_done} jobs executed, no more jobs available" )
+        case "status":
+            workq.write_status( sys.stdout )
+
+
+def compile_bundle():
+    """
+    Render all the prompts of the execution, or of all the jobs of the sweep, into cnfg.bundle_file
+    (see bundle.py), and prepare the images in the variants for the interfaces of the models
+    """
+    assert cnfg.bundle_file is not None, "error: no bundle_file in the configuration"
+    jobs        = sweep.plan() if cnfg.multi_exec == "sweep" else [ dict() ]
+    model_ids   = { job.get( "model_id", cnfg.model_id ) for job in jobs }
+    if cnfg.multi_exec == "fanout":
+        model_ids   = set( cnfg.fanout_models )
+    targets     = { prmpt.image_target( models_interface[ models[ i ] ] ) for i in model_ids } - { None }
+
+    prompts     = dict()
+    images      = set()
+    for job in jobs:
+        variant = prompt_variant( job )
+        vkey    = bundle.variant_key( **variant )
+        for with_img in batch_arms.get( job.get( "experiment", cnfg.experiment ), [] ):
+            for news_id in cnfg.news_ids:
+                if ( news_id, with_img, vkey ) in prompts:
+                    continue
+                prompts[ ( news_id, with_img, vkey ) ]  = prmpt.render_segments( news_id, with_img, **variant )
+                if with_img:
+                    images.add( prompts[ ( news_id, with_img, vkey ) ][ 1 ] )
+
+    for fimage in images:
+        for target in targets:
+            prmpt.image_b64( fimage, target )               # stored on disk, ready for the execution
+
+    n_prompts, n_segments, size = bundle.compile( cnfg.bundle_file, cnfg.news_ids, prompts, prmpt.source_files() )
+    print( f"{n_prompts} prompts of {len( cnfg.news_ids )} news compiled in {cnfg.bundle_file}, "
+           f"with {n_segments} distinct text segments of {size} bytes, and {len( images )} images "
+           f"for {len( targets )} targets" )
 
 
 # ===================================================================================================================
@@ -415,18 +695,25 @@ if __name__ == '__main__':
 
     else:
         init_cnfg()
-        init_dirs()
-        if cnfg.experiment is not None:
-            if cnfg.DEBUG:
-                print( "Program running in DEBUG mode, not archiving" )
-            else:
-                archive()
-            match cnfg.multi_exec:
-                case "single":
-                    do_exec()
-                case "dialogs_pre":
-                    multi_dialogs_pre()
-                case "demography":
-                    multi_demography()
-                case _:
-                    print( "execution mode {cnfg.multi_exec} not implemented" )
+        if cnfg.PLAN:
+            sweep.write_plan( sys.stdout, sweep.plan() )
+            sys.exit()
+        if cnfg.COMPILE:
+            compile_bundle()
+            sys.exit()
+        if cnfg.QUEUE is not None:
+            queue_exec()
+            sys.exit()
+        if cnfg.experiment is not None and cnfg.multi_exec == "sweep":
+            multi_sweep()                                       # each run has its own folder of results
+        elif cnfg.experiment is not None and cnfg.multi_exec == "fanout":
+            multi_fanout()                                      # each model has its own folder of results
+        else:
+            prmpt.rendered  = load_bundle()
+            init_dirs()
+            if cnfg.experiment is not None:
+                if cnfg.DEBUG:
+                    print( "Program running in DEBUG mode, not archiving" )
+                elif not cnfg.RECOVER:                          # a recovered execution is already archived
+                    archive()
+                do_exec()
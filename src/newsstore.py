@@ -0,0 +1,100 @@
+"""
+#####################################################################################################################
+
+    Module to access the dataset of news
+
+    The JSON file of the news is read once for each process, and the records are indexed by news id.
+    Images are opened only when requested.
+
+#####################################################################################################################
+"""
+
+import  os
+import  json
+from    PIL         import Image
+
+dir_imgs                = "../imgs"             # directory with news images
+stores                  = dict()                # NewsStore for each file already read
+
+
+# ===================================================================================================================
+#
+#   - NewsStore
+#   - get_store
+#
+# ===================================================================================================================
+
+class NewsStore( object ):
+    """
+    Records of the news of one JSON file, in the order of the file and indexed by id
+    """
+
+    def __init__( self, fname ):
+        """
+        params:
+            fname       [str] JSON file of the news, with path
+        """
+        with open( fname, 'r' ) as f:
+            self.data   = json.load( f )
+        self.index      = { d[ 'id' ]: d for d in self.data }
+
+
+    def ids( self ):
+        """
+        return:         [list] of [str] the ids of all news, in the order of the file
+        """
+        return [ d[ 'id' ] for d in self.data ]
+
+
+    def records( self ):
+        """
+        return:         [list] of [dict] all the records, in the order of the file
+        """
+        return self.data
+
+
+    def get( self, news_id ):
+        """
+        params:
+            news_id     [str] id of the news
+
+        return:         [dict] the record of the news, raises KeyError for a missing news
+        """
+        return self.index[ news_id ]
+
+
+    def image_path( self, news_id ):
+        """
+        params:
+            news_id     [str] id of the news
+
+        return:         [str] the file of the image of the news, with path
+        """
+        return os.path.join( dir_imgs, self.index[ news_id ][ "image" ] )
+
+
+    def image( self, news_id ):
+        """
+        Open the image of a news
+
+        params:
+            news_id     [str] id of the news
+
+        return:         [PIL.JpegImagePlugin.JpegImageFile]
+        """
+        return Image.open( self.image_path( news_id ) )
+
+
+def get_store( fname ):
+    """
+    Return the store of a file of news, reading it the first time
+
+    params:
+        fname       [str] JSON file of the news, with path
+
+    return:         [NewsStore]
+    """
+    key     = os.path.abspath( fname )
+    if key not in stores:
+        stores[ key ]   = NewsStore( fname )
+    return stores[ key ]
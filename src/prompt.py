@@ -10,10 +10,11 @@
 import  os
 import  sys
 import  string
-import  base64
-import  json
-from    PIL         import Image
-from    io          import BytesIO
+
+import  newsstore                                   # this module reads the news once for each process
+import  templates                                   # this module reads the dialogs once for each process
+import  imgcache                                    # this module caches the images ready to send
+import  bundle                                      # this module compiles the prompts ahead of execution
 
 
 dir_json                = "../data"                 # directory with all input data
@@ -24,20 +25,58 @@ f_news                  = None                      # filename of the news tests
 detail                  = "high"                    # parameter for OpenAI image, overwritten by cnfg
 native_res              = ( 672, 672 )              # resolution of blank image
 insert_blank            = False                     # directive to insert a blank image in case of text only
+cache_control           = { "type": "ephemeral" }   # marker of anthropic prompt blocks to cache
+rendered                = None                      # prompts rendered ahead, see render_news() and bundle.py
 DEBUG                   = False                     # local debugging
 
 
 # ===================================================================================================================
 #
 #   Utilities to read data
+#   - news_store
+#   - dialog_registry
+#   - source_files
 #   - list_news
 #   - image_pil
 #   - image_b64
+#   - image_handle
+#   - image_target
 #   - get_dialog
 #   - get_news
 #
 # ===================================================================================================================
 
+def news_store():
+    """
+    Return the store of the news in f_news, read once for each process
+
+    return:     [newsstore.NewsStore]
+    """
+    return newsstore.get_store( os.path.join( dir_json, f_news ) )
+
+
+def dialog_registry():
+    """
+    Return the registry of the dialogs in f_dialog, with the demographic data in f_demo, read once for each process
+
+    return:     [templates.DialogRegistry]
+    """
+    fdemo   = os.path.join( dir_json, f_demo ) if f_demo is not None else None
+    return templates.get_registry( os.path.join( dir_json, f_dialog ), fdemo )
+
+
+def source_files():
+    """
+    Return the JSON files the prompts are composed from
+
+    return:     [list] of [str] files with path
+    """
+    files   = [ os.path.join( dir_json, f_news ), os.path.join( dir_json, f_dialog ) ]
+    if f_demo is not None:
+        files.append( os.path.join( dir_json, f_demo ) )
+    return files
+
+
 def list_news( n=None ):
     """
     Return the list with all ID of the news found in the JSON dataset
@@ -46,10 +85,7 @@ def list_news( n=None ):
         n:      [int] number of news to return
     return:     [list] with news IDs
     """
-    fname   = os.path.join( dir_json, f_news )
-    with open( fname, 'r' ) as f:
-        data    = json.load( f )
-    ids     = [ d[ 'id' ] for d in data ]
+    ids     = news_store().ids()
 
     # select only first n/2 false and n/2 true news
     if n is not None:
@@ -78,10 +114,7 @@ def list_profiles():
 
     return:     [list] with profiling dialogs IDs
     """
-    fname   = os.path.join( dir_json, f_dialog )
-    with open( fname, 'r' ) as f:
-        data    = json.load( f )
-    ids     = [ d[ 'id' ] for d in data ]
+    ids     = dialog_registry().ids()
 
     p_ids   = [ i for i in ids if i.startswith( "p_" ) ]
 
@@ -90,44 +123,66 @@ def list_profiles():
 
 def image_pil( i ):
     """
-    Return an image as PIL object, as requested in LlaVa prompts
+    Return an image as PIL object, as requested in LlaVa prompts, already resized for the HuggingFace models
 
     params:
         i       [int] id of the news linked to the image
 
-    return:     [PIL.JpegImagePlugin.JpegImageFile]
+    return:     [PIL.Image.Image]
     """
-    fname   = os.path.join( dir_json, f_news )
-    with open( fname, 'r' ) as f:
-        data    = json.load( f )
-    ids     = [ d[ 'id' ] for d in data ]
-
     try:
-        idx     = ids.index( i )
-    except Exception as e:
+        img     = imgcache.image( news_store().image_path( i ), "hf" )
+    except KeyError as e:
         print( f"ERROR: non existing news with ID={i} in image_pil()" )
         raise e
 
-    img_name    = data[ idx ][ "image" ]
-    fname       = os.path.join( dir_imgs, img_name )
-    img         = Image.open( fname )
     return img
 
 
-def image_b64( fname ):
+def image_b64( fname, target="orig" ):
     """
-    Return an image as b64encoded string, as requested in OpenAi prompts
+    Return an image as b64encoded string, as requested in OpenAi prompts, from the cache of imgcache.py
 
     params:
         fname   [str] name of the file, without path
+        target  [str] the variant of the image, see imgcache.py
 
     return:     [bytes] the b64encoded image
     """
-    fname       = os.path.join( dir_imgs, fname )
-    with open( fname, 'rb' ) as f:
-        img_str     = base64.b64encode( f.read() ).decode( "utf-8" )
+    return imgcache.variant( os.path.join( dir_imgs, fname ), target ).b64
+
+
+def image_handle( fname, target="orig", digest=None ):
+    """
+    Return the handle of an image, resolved to the b64encoded image only when the request is sent
+
+    params:
+        fname   [str] name of the file, without path
+        target  [str] the variant of the image, see imgcache.py
+        digest  [str] digest of the file if already known, or None
+
+    return:     [str] the handle
+    """
+    return imgcache.handle( os.path.join( dir_imgs, fname ), target, digest=digest )
 
-    return img_str
+
+def image_target( interface ):
+    """
+    Return the variant of the images sent to an interface
+
+    params:
+        interface   [str] as in format_prompt()
+
+    return:     [str] the target in imgcache.py, or None if the images are passed as files
+    """
+    match interface:
+        case "openai" | "none":
+            return "openai_low" if detail == "low" else "openai_high"
+        case "anthro":
+            return "anthro"
+        case "hf" | "qwen":
+            return "hf"
+    return None
 
 
 def blank_b64():
@@ -136,12 +191,7 @@ def blank_b64():
 
     return:     [bytes] the b64encoded image
     """
-    image       = Image.new( mode='L', size=native_res, color="black" )
-    buffer      = BytesIO()
-    image.save( buffer, format="JPEG" )
-    img_str     = base64.b64encode( buffer.getvalue() ).decode( "utf-8" )
-
-    return img_str
+    return imgcache.blank( native_res ).b64
 
 
 def get_dialog( id_dialog, with_img, demographics=None ):
@@ -161,54 +211,12 @@ def get_dialog( id_dialog, with_img, demographics=None ):
     if not len( id_dialog ):
         return ''
 
-    fname = os.path.join(dir_json, f_dialog)
-
-    with open(fname, 'r') as f:
-        data = json.load(f)
-    ids = [ d['id'] for d in data ]
+    registry    = dialog_registry()
+    if id_dialog not in registry:
+        print( f"ERROR: non-existing dialog '{id_dialog}' in get_dialog()" )
+        raise KeyError( id_dialog )
 
-    try:
-        idx = ids.index( id_dialog )
-    except Exception as e:
-        print( f"ERROR: non-existing dialog '{i}' in get_dialog()" )
-        raise e
-
-    if with_img and "content_img" in data[ idx ]:
-        text    = data[ idx ][ "content_img" ]
-    else:
-        text    = data[ idx ][ "content" ]
-
-    let_compl   = "completion_mode" in data[ idx ].keys()
-
-    # If demographics are included, process them
-    if demographics:
-        # Load valid demographic attributes
-        dfile = os.path.join( dir_json, f_demo )
-        with open(dfile, 'r') as f:
-            valid_demographics = json.load(f)
-
-        # Validate demographics against available options
-        valid_keys = valid_demographics.keys()
-        for key, value in demographics.items():
-            if key not in valid_keys or value not in valid_demographics[key]:
-                raise ValueError(f"Invalid demographic value: {key} = {value}")
-
-        # Retrieve and format content_dems
-        try:
-            content_dems = next(item['content'] for item in data if item['id'] == 'content_dems')
-        except StopIteration:
-            raise ValueError(f"ERROR: Missing 'content_dems' entry in {f_demo}")
-
-        # Dynamically format demographics into content_dems
-        content_dems_filled = content_dems.format(**demographics)
-
-        # Insert demographic content into the main text
-        text = text.replace("{content_dems}", content_dems_filled)
-    # otherwise, remove the {content_dems} slot
-    else:
-        text = text.replace( "{content_dems}", '' )
-
-    return text, let_compl
+    return registry.render( id_dialog, with_img, demographics=demographics )
 
 
 def get_news( news, source=False, more=False ):
@@ -246,6 +254,8 @@ def get_news( news, source=False, more=False ):
 #   Functions composing prompts
 #   - prune_prompt
 #   - compose_prompt
+#   - render_segments
+#   - render_news
 #   - format_prompt
 #
 # ===================================================================================================================
@@ -268,7 +278,8 @@ def prune_prompt( prompt ):
         else:
             role    = p[ "role" ]
             if "text" in p[ "content" ][ 0 ]:
-                text    = p[ "content" ][ 0 ][ "text" ]
+                # the text can be split in several blocks, like in anthropic prompts with cached blocks
+                text    = ''.join( c[ "text" ] for c in p[ "content" ] if c[ "type" ] == "text" )
                 # text    = text.lstrip()                     # remove annoying leading whitespace characters
                 pruned.append( { "role": role, "content": text } )
 
@@ -282,7 +293,8 @@ def compose_prompt(
         with_img=True,
         source=False,
         more=False,
-        demographics=None):
+        demographics=None,
+        split=False):
     """
     Compose the text of a prompt processing one news
 
@@ -294,35 +306,31 @@ def compose_prompt(
         source      [bool] add info about the source of the news
         more        [bool] add more available info about the news, like number of share/followers
         demographics [dict] demographics data, or None
+        split       [bool] return the text before the news separated from the rest
 
-    return:         [str] the prompt
+    return:         [str] the prompt, or [tuple] with text before the news and the rest if split
                     [str] image name or "" if not with_img
                     [bool] flag that the chat mode is chat-completion
     """
-    fname   = os.path.join( dir_json, f_news )
-    with open( fname, 'r' ) as f:
-        data    = json.load( f )
-    ids     = [ d[ 'id' ] for d in data ]
-
     try:
-        idx     = ids.index( news_id )
-    except Exception as e:
+        news    = news_store().get( news_id )
+    except KeyError as e:
         print( f"ERROR: non existing news with ID {news_id} in compose_prompt()" )
         raise e
 
+    pre_text            = ""
     full_text           = ""
-    news                = data[ idx ]
     text                = get_news( news, source=source, more=more )
     fimage              = news[ "image" ] if with_img else ''
 
     if isinstance( pre, list ):
         for p in pre:
             t,let_compl = get_dialog(p, with_img, demographics=demographics)
-            full_text   += f"{t} "
+            pre_text    += f"{t} "
 
     elif isinstance( pre, str ):
         t,let_compl = get_dialog(pre, with_img, demographics=demographics)
-        full_text   += f"{t} "
+        pre_text    += f"{t} "
 
     full_text   += f"\n{text}\n"
 
@@ -335,7 +343,98 @@ def compose_prompt(
         t,let_compl = get_dialog(post, with_img, demographics=demographics)
         full_text   += f"{t} "
 
-    return full_text, fimage, let_compl
+    if split:
+        return ( pre_text, full_text ), fimage, let_compl
+    return pre_text + full_text, fimage, let_compl
+
+
+def render_segments(
+        news_id,
+        with_img=True,
+        pre="",
+        post="",
+        source=False,
+        more=False,
+        demographics=None):
+    """
+    Compose the text of a prompt in three segments: the text before the news, the news, and the text after
+    the news, as stored in the bundles of bundle.py
+
+    params:
+        news_id     [str] id of the news
+        with_img    [bool] the news contains an image
+        pre         [str] or [list of str] optional ids of text before the news content
+        post        [str] or [list of str] optional ids of text after the news content
+        source      [bool] add info about the source of the news
+        more        [bool] add more available info about the news, like number of share/followers
+        demographics [dict] demographics data, or None
+
+    return:         [tuple] of the three [str] segments
+                    [str] image name or "" if not with_img
+                    [str] digest of the image file, or None if not with_img
+                    [bool] flag that the chat mode is chat-completion
+    """
+    ( pre_text, full_text ), fimage, let_compl  = compose_prompt(
+                            news_id,
+                            pre         = pre,
+                            post        = post,
+                            with_img    = with_img,
+                            source      = source,
+                            more        = more,
+                            demographics=demographics,
+                            split       = True,
+    )
+    body    = "\n{}\n".format( get_news( news_store().get( news_id ), source=source, more=more ) )
+    assert full_text.startswith( body ), f"ERROR: unexpected composition of news {news_id}"
+    digest  = imgcache.file_digest( os.path.join( dir_imgs, fimage ) ) if with_img else None
+    return ( pre_text, body, full_text[ len( body ) : ] ), fimage, digest, let_compl
+
+
+def render_news(
+        news_ids,
+        with_img=True,
+        pre="",
+        post="",
+        source=False,
+        more=False,
+        demographics=None,
+        targets=()):
+    """
+    Compose the text of the prompts of several news once for all models, and prepare the variants of
+    their images for the targets of the models.
+    The result, assigned to the global rendered, is used by format_prompt() instead of composing again
+    the prompts, when called with the same arguments
+
+    params:
+        news_ids    [list] of [str] ids of the news
+        with_img    [bool] the news contains an image
+        pre         [str] or [list of str] optional ids of text before the news content
+        post        [str] or [list of str] optional ids of text after the news content
+        source      [bool] add info about the source of the news
+        more        [bool] add more available info about the news, like number of share/followers
+        demographics [dict] demographics data, or None
+        targets     [list] of [str] variants of the images, see image_target()
+
+    return:         [dict] with key ( news_id, with_img, variant ) and value the [tuple] returned by
+                    compose_prompt() with split, followed by the digest of the image or None,
+                    where variant is returned by bundle.variant_key()
+    """
+    res     = dict()
+    vkey    = bundle.variant_key( pre, post, source, more, demographics )
+    for news_id in news_ids:
+        ( pre_text, body, post_text ), fimage, digest, let_compl   = render_segments(
+                            news_id,
+                            pre         = pre,
+                            post        = post,
+                            with_img    = with_img,
+                            source      = source,
+                            more        = more,
+                            demographics=demographics,
+        )
+        for t in targets if with_img else ():
+            image_b64( fimage, t )                  # stored in the cache shared with the other processes
+        res[ ( news_id, with_img, vkey ) ]  = ( ( pre_text, body + post_text ), fimage, let_compl, digest )
+    return res
 
 
 def format_prompt(
@@ -352,6 +451,9 @@ def format_prompt(
     Format the prompt for the language model.
     For OpenAI interface, the image is passed within the prompt.
     For HF interface, the image is passed separately in complete.py, but not in the case of gemma
+    The text of prompts already rendered by render_news(), or compiled in a bundle, with the same
+    arguments is reused. The images are referenced by
+    handles of their variant for the interface, resolved when the requests are sent (see imgcache.py).
 
     params:
         news        [str] id of the news
@@ -367,7 +469,12 @@ def format_prompt(
     return:         [list] the prompt
                     [str] image name or "" if not with_img
     """
-    full_text, fimage, let_compl  = compose_prompt(
+    digest      = None
+    key         = ( news_id, with_img, bundle.variant_key( pre, post, source, more, demographics ) )
+    if rendered is not None and key in rendered:
+        ( pre_text, news_text ), fimage, let_compl, digest  = rendered[ key ]
+    else:
+        ( pre_text, news_text ), fimage, let_compl  = compose_prompt(
                             news_id,
                             pre         = pre,
                             post        = post,
@@ -375,7 +482,9 @@ def format_prompt(
                             source      = source,
                             more        = more,
                             demographics=demographics,
-    )
+                            split       = True,
+        )
+    full_text   = pre_text + news_text
 
 #   if DEBUG:   full_text = "describe the content of this image"
 
@@ -384,13 +493,13 @@ def format_prompt(
             # OpenAI with image included as string in the prompt
             if with_img or insert_blank:
                 if with_img:
-                    image               = image_b64( fimage )
+                    image               = image_handle( fimage, image_target( interface ), digest=digest )
                 else:
-                    image               = blank_b64()
+                    image               = imgcache.blank_handle( native_res )
                 img_content         = {
                         "type":         "image_url",
                         "image_url" :   {
-                            "url":      f"data:image/jpeg;base64,{image}",
+                            "url":      image,          # data url at send time, see imgcache.resolve()
                             "detail":   detail
                         }
                     }
@@ -407,31 +516,31 @@ def format_prompt(
                 prompt      = [ { "role": "user", "content": full_text } ]
 
         case "anthro":
+            # anthropic with the text before the news as a separate block, marked for caching, since it is
+            # the same for all news; the end of the prompt is marked as well, to cache it for all samples
+            content             = []
+            if len( pre_text.strip() ):
+                content.append( { "type": "text", "text": pre_text, "cache_control": cache_control } )
+            content.append( { "type": "text", "text": news_text } )
+
             # anthropic with image included as string in the prompt
             if with_img or insert_blank:
                 if with_img:
-                    image               = image_b64( fimage )
+                    image               = image_handle( fimage, image_target( interface ), digest=digest )
                 else:
-                    image               = blank_b64()
+                    image               = imgcache.blank_handle( native_res )
                 img_content         = {
                         "type":         "image",
                         "source" :   {
                             "type":         "base64",
-                            "media_type":   "image/jpeg",
-                            "data":         image,
+                            "media_type":   "image/jpeg",   # the type of the image, set at send time
+                            "data":         image,          # b64encoded at send time, see imgcache.resolve()
                         }
                     }
-                prompt      = [ {
-                    "role":     "user",
-                    "content":  [
-                        { "type": "text", "text": full_text },
-                        img_content
-                    ]
-                } ]
+                content.append( img_content )
 
-            # anthropic without image
-            else:
-                prompt      = [ { "role": "user", "content": full_text } ]
+            content[ -1 ][ "cache_control" ]    = cache_control
+            prompt      = [ { "role": "user", "content": content } ]
 
         # HuggingFace Qwen with or without image (the image is handled in complete.py)
         case "qwen":
@@ -0,0 +1,297 @@
+"""
+#####################################################################################################################
+
+    Module to pace the requests to remote models under their rate limits
+
+    The limits are given in the configuration file as "rate_limits", a dict keyed by model name or
+    by interface name, with values as dict of limits per minute, for example:
+
+        'rate_limits':  {
+            "gpt-4o-mini":  { "rpm": 5000, "tpm": 4000000 },
+            "anthro":       { "rpm": 50, "itpm": 50000, "otpm": 10000 },
+        }
+
+    where "rpm" is for requests, "itpm" for input tokens, "otpm" for output tokens, and "tpm" for
+    input plus output tokens. A model without limits is not paced.
+
+#####################################################################################################################
+"""
+
+import  time
+import  math
+import  base64
+import  asyncio
+import  threading
+from    io          import BytesIO
+from    PIL         import Image
+
+import  imgcache                                # this module caches the images sent to remote models
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+
+burst_seconds           = 10                    # capacity of the buckets, in seconds of quota
+chars_per_token         = 4                     # rough estimate of characters per text token
+limit_keys              = ( "rpm", "itpm", "otpm", "tpm" )
+buckets                 = dict()                # bucket per ( interface, model ), created on first use
+buckets_lock            = threading.Lock()      # guard for the creation of buckets from threads
+
+
+# ===================================================================================================================
+#
+#   Estimate of tokens
+#   - image_size
+#   - image_tokens
+#   - prompt_tokens
+#
+# ===================================================================================================================
+
+def image_size( data ):
+    """
+    Return the size of a b64encoded image, reading the image header only
+
+    params:
+        data        [str] the b64encoded image, or its handle (see imgcache.py)
+
+    return:         [tuple] width and height in pixels
+    """
+    if imgcache.is_handle( data ):
+        return imgcache.lookup( data ).size
+    image   = Image.open( BytesIO( base64.b64decode( data ) ) )
+    return image.size
+
+
+def image_tokens( interface, size, detail="high" ):
+    """
+    Estimate the input tokens of an image, following the rules published by each provider
+
+    params:
+        interface   [str] "openai" or "anthro"
+        size        [tuple] width and height in pixels
+        detail      [str] detail parameter for OpenAI image
+
+    return:         [int] number of tokens
+    """
+    w, h    = size
+
+    if interface == "anthro":
+        scale   = min( 1., 1568 / max( w, h ) )         # images are scaled to 1568 pixels of long edge
+        return math.ceil( w * scale * h * scale / 750 )
+
+    if detail == "low":
+        return 85
+    scale   = min( 1., 2048 / max( w, h ) )             # fit within 2048 x 2048
+    w, h    = w * scale, h * scale
+    scale   = min( 1., 768 / min( w, h ) )              # then shortest side at 768
+    w, h    = w * scale, h * scale
+    tiles   = math.ceil( w / 512 ) * math.ceil( h / 512 )
+    return 85 + 170 * tiles
+
+
+def prompt_tokens( interface, prompt ):
+    """
+    Estimate the input tokens of a prompt, including the images
+
+    params:
+        interface   [str] "openai" or "anthro"
+        prompt      [str] or [list] the prompt for completion-mode models,
+                    or the messages for chat-mode models
+
+    return:         [int] number of tokens
+    """
+    if isinstance( prompt, str ):
+        return math.ceil( len( prompt ) / chars_per_token )
+
+    chars   = 0
+    tokens  = 0
+    for p in prompt:
+        content = p[ "content" ]
+        if isinstance( content, str ):
+            chars   += len( content )
+            continue
+        for c in content:
+            match c[ "type" ]:
+                case "text":
+                    chars   += len( c[ "text" ] )
+                case "image_url":
+                    data    = c[ "image_url" ][ "url" ].split( "base64," )[ -1 ]
+                    detail  = c[ "image_url" ].get( "detail", "high" )
+                    tokens  += image_tokens( interface, image_size( data ), detail=detail )
+                case "image":
+                    data    = c[ "source" ][ "data" ]
+                    tokens  += image_tokens( interface, image_size( data ) )
+
+    return tokens + math.ceil( chars / chars_per_token )
+
+
+# ===================================================================================================================
+#
+#   Token buckets
+#   - TokenBucket
+#   - get_bucket
+#   - reserve
+#   - acquire
+#   - aacquire
+#   - settle
+#
+# ===================================================================================================================
+
+class TokenBucket( object ):
+    """
+    Buckets refilled continuously at the rate of the limits per minute, one for each limit.
+    A request is debited in advance, even if a bucket goes below zero, and should wait the time
+    needed to bring back all buckets at zero. In this way requests from threads and coroutines
+    are paced in their order of arrival.
+    """
+
+    def __init__( self, limits, margin=1. ):
+        """
+        params:
+            limits      [dict] limits per minute, with keys "rpm", "itpm", "otpm", "tpm"
+            margin      [float] fraction of the limits to use
+        """
+        for k in limits:
+            if k not in limit_keys:
+                raise ValueError( f"error in configuration: rate limit '{k}' not supported, use one of {limit_keys}" )
+        self.rates      = { k: margin * v / 60. for k, v in limits.items() }    # refill per second
+        self.capacity   = { k: burst_seconds * r for k, r in self.rates.items() }
+        self.levels     = dict( self.capacity )                                 # start with full buckets
+        self.last       = time.monotonic()
+        self.lock       = threading.Lock()
+
+
+    def refill( self ):
+        """
+        Refill the buckets for the time elapsed since the last refill
+        NOTE: to be called with the lock acquired
+        """
+        now         = time.monotonic()
+        elapsed     = now - self.last
+        self.last   = now
+        for k, r in self.rates.items():
+            self.levels[ k ]    = min( self.capacity[ k ], self.levels[ k ] + elapsed * r )
+
+
+    def debit( self, amounts ):
+        """
+        Debit a request and return the seconds to wait before sending it
+
+        params:
+            amounts     [dict] amounts per limit, with keys "rpm", "itpm", "otpm", "tpm"
+
+        return:         [float] seconds to wait
+        """
+        wait    = 0.
+        with self.lock:
+            self.refill()
+            for k, r in self.rates.items():
+                # a request larger than the capacity would never be served
+                self.levels[ k ]    -= min( amounts[ k ], self.capacity[ k ] )
+                if self.levels[ k ] < 0:
+                    wait    = max( wait, -self.levels[ k ] / r )
+        return wait
+
+
+    def credit( self, amounts ):
+        """
+        Give back amounts that were debited in excess
+
+        params:
+            amounts     [dict] amounts per limit, possibly only a part of them
+        """
+        with self.lock:
+            self.refill()
+            for k, v in amounts.items():
+                if k in self.levels:
+                    self.levels[ k ]    = min( self.capacity[ k ], self.levels[ k ] + v )
+
+
+def get_bucket( interface, model ):
+    """
+    Return the bucket of a model, looking for limits first by model name then by interface name
+
+    params:
+        interface   [str] the interface of the model
+        model       [str] the model name
+
+    return:         [TokenBucket] or None if the model has no limits
+    """
+    key     = ( interface, model )
+    with buckets_lock:
+        if key not in buckets:
+            limits  = cnfg.rate_limits.get( model, cnfg.rate_limits.get( interface ) )
+            buckets[ key ]  = TokenBucket( limits, margin=cnfg.rate_margin ) if limits else None
+    return buckets[ key ]
+
+
+def reserve( interface, model, prompt, n=1 ):
+    """
+    Debit a request on the bucket of the model
+
+    params:
+        interface   [str] the interface of the model
+        model       [str] the model name
+        prompt      [str] or [list] the prompt of the request
+        n           [int] number of returns of the request
+
+    return:         [tuple] the ticket of the request: bucket, estimated output tokens, seconds to wait
+    """
+    bucket  = get_bucket( interface, model )
+    if bucket is None:
+        return None, 0, 0.
+
+    n_in    = prompt_tokens( interface, prompt )
+    n_out   = n * cnfg.max_tokens                   # the worst case, corrected by settle()
+    amounts = { "rpm": 1, "itpm": n_in, "otpm": n_out, "tpm": n_in + n_out }
+    wait    = bucket.debit( amounts )
+    return bucket, n_out, wait
+
+
+def acquire( interface, model, prompt, n=1 ):
+    """
+    Wait until a request can be sent within the rate limits of the model
+
+    params:
+        interface   [str] the interface of the model
+        model       [str] the model name
+        prompt      [str] or [list] the prompt of the request
+        n           [int] number of returns of the request
+
+    return:         [tuple] the ticket of the request, to be passed to settle()
+    """
+    ticket  = reserve( interface, model, prompt, n=n )
+    if ticket[ 2 ] > 0:
+        time.sleep( ticket[ 2 ] )
+    return ticket
+
+
+async def aacquire( interface, model, prompt, n=1 ):
+    """
+    Wait until a request can be sent within the rate limits of the model, without blocking the event loop
+
+    params:
+        interface   [str] the interface of the model
+        model       [str] the model name
+        prompt      [str] or [list] the prompt of the request
+        n           [int] number of returns of the request
+
+    return:         [tuple] the ticket of the request, to be passed to settle()
+    """
+    ticket  = reserve( interface, model, prompt, n=n )
+    if ticket[ 2 ] > 0:
+        await asyncio.sleep( ticket[ 2 ] )
+    return ticket
+
+
+def settle( ticket, n_out ):
+    """
+    Give back the output tokens that were estimated in excess, once the actual usage is known
+
+    params:
+        ticket      [tuple] as returned by acquire()
+        n_out       [int] actual output tokens, or None if unknown
+    """
+    bucket, est_out, _  = ticket
+    if bucket is None or n_out is None:
+        return
+    excess  = max( 0, est_out - n_out )
+    bucket.credit( { "otpm": excess, "tpm": excess } )
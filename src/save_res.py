@@ -9,6 +9,7 @@
 import  os
 import  sys
 import  copy
+import  json
 import  platform
 import  pickle
 import  csv
@@ -17,11 +18,89 @@ import  numpy       as np
 cnfg                = None                  # parameter obj assigned by main_exec.py
 
 
+# ===================================================================================================================
+#
+#   Functions to stream the results of each news during the execution
+#   - encode_score
+#   - decode_score
+#   - append_record
+#   - read_records
+#
+# ===================================================================================================================
+
+def encode_score( score ):
+    """
+    Convert the scores returned by conversation.check_reply() into json-compatible values
+
+    params:
+        score       [np.array] or [dict] of [np.array]
+
+    return:         [dict] or [list] with arrays as dict with values and dtype
+    """
+    if isinstance( score, dict ):
+        return { k: encode_score( v ) for k, v in score.items() }
+    if isinstance( score, np.ndarray ):
+        return { "ndarray": score.tolist(), "dtype": str( score.dtype ) }
+    return score
+
+
+def decode_score( score ):
+    """
+    Convert back the scores encoded by encode_score()
+
+    params:
+        score       [dict] or [list] as returned by encode_score()
+
+    return:         [np.array] or [dict] of [np.array]
+    """
+    if isinstance( score, dict ):
+        if "ndarray" in score:
+            return np.array( score[ "ndarray" ], dtype=score[ "dtype" ] )
+        return { k: decode_score( v ) for k, v in score.items() }
+    return score
+
+
+def append_record( fname, record ):
+    """
+    Append one record to a JSONL file, syncing it to disk.
+    The cost does not grow with the records already written, and an aborted execution loses at most
+    the record being written.
+
+    params:
+        fname       [str] jsonl file with path and extension
+        record      [dict] json-compatible
+    """
+    with open( fname, 'a', encoding="utf-8" ) as f:
+        f.write( json.dumps( record, ensure_ascii=False ) + "\n" )
+        f.flush()
+        os.fsync( f.fileno() )
+
+
+def read_records( fname ):
+    """
+    Read all records of a JSONL file, ignoring a trailing line truncated by an abort
+
+    params:
+        fname       [str] jsonl file with path and extension
+
+    return:         [list] of [dict]
+    """
+    records     = []
+    with open( fname, 'r', encoding="utf-8" ) as f:
+        for line in f:
+            try:
+                records.append( json.loads( line ) )
+            except json.JSONDecodeError:
+                break
+    return records
+
+
 # ===================================================================================================================
 #
 #   Functions to write the results on pickle file and compute stats on it
 #   - write_pickle
 #   - get_pickle
+#   - write_usage
 #   - write_stats
 #
 # ===================================================================================================================
@@ -49,6 +128,24 @@ def get_pickle( fname ):
         return pickle.load( f )
 
 
+def write_usage( fcsv, usage ):
+    """
+    Write in CSV file the tokens used by each request to remote models, or other records with the same keys,
+    like the changes of the limits of requests in flight (see aimd.Controller.log())
+
+    params:
+        fcsv        [str] csv file with path and extension
+        usage       [list] of [dict] with the usage of each request, see complete.record_usage()
+    """
+    if not len( usage ):
+        return
+    csv_header  = list( usage[ 0 ].keys() )
+    with open( fcsv, mode='w', newline='' ) as f:
+        w   = csv.DictWriter( f, fieldnames=csv_header )
+        w.writeheader()
+        w.writerows( usage )
+
+
 def write_stats_bool( fcsv, results ):
     """
     Write in CSV file stats about the results, either from the pickle file or from the data passed
@@ -258,6 +355,7 @@ def write_stats( fcsv, fpkl=None, results=None, likert=False, agreement=False ):
 #
 #   Functions to write the results on textual log file
 #   - write_header
+#   - write_run_stats
 #   - write_dialog
 #   - write_dialogs
 #   - write_all
@@ -284,6 +382,22 @@ def write_header( fstream ):
     fstream.write( "\n" + 60 * "=" + "\n\n" )
 
 
+def write_run_stats( fstream, stats ):
+    """
+    Write the counters collected during the execution, like requests and retries to remote models
+
+    params:
+        fstream     [TextIOWrapper] text stream of the output file
+        stats       [dict] counters of the run
+    """
+    if not len( stats ):
+        return
+    fstream.write( "run statistics:\n" )
+    for k in sorted( stats ):
+        fstream.write( "{:5}{:<30}{}\n".format( '', k, stats[ k ] ) )
+    fstream.write( "\n" + 60 * "=" + "\n\n" )
+
+
 def write_dialog( fstream, prompt, completions, mode="chat" ):
     """
     Write the content of prompts and completions on the log file
@@ -301,11 +415,8 @@ def write_dialog( fstream, prompt, completions, mode="chat" ):
             fstream.write( f"ROLE: {p['role']}\n" )
             c   = p[ 'content' ]
             if not isinstance( c, str ):
-                text    = ''
-                for t in c:
-                    if t[ "type" ] == "text":
-                        text        = t[ "text" ]
-                        break
+                # the text can be split in several blocks, like in anthropic prompts with cached blocks
+                text    = ''.join( t[ "text" ] for t in c if t[ "type" ] == "text" )
             else:
                 text    = c
             fstream.write( f"PROMPT:\n{text}\n\n" )
@@ -342,7 +453,8 @@ def write_dialogs( fstream, prompts, completions, img_names, mode="chat" ):
         fstream.write( 60 * "=" + "\n" )
 
 
-def write_all( fstream, prompts, completions, results, img_names, fcsv, fpkl, mode="chat", likert=False, agreement=False ):
+def write_all( fstream, prompts, completions, results, img_names, fcsv, fpkl, mode="chat", likert=False, agreement=False,
+        stats=None ):
     """
     Write all result files (text log, csv, pkl)
 
@@ -357,10 +469,13 @@ def write_all( fstream, prompts, completions, results, img_names, fcsv, fpkl, mo
         mode        [str] "cmpl" or "chat"
         likert      [bool] results are for Likert scale
         agreement   [bool] include agreement measure
+        stats       [dict] optional counters of the run
     """
     write_pickle( fpkl, results )
     write_stats( fcsv, results=results, likert=likert, agreement=agreement )
     write_header( fstream )
+    if stats is not None:
+        write_run_stats( fstream, stats )
 
     # unix command to pretty print the csv in the text log
     cmd     = f"column -s, -t <{fcsv}"
@@ -0,0 +1,381 @@
+"""
+#####################################################################################################################
+
+    Module to plan sweeps of multiple executions
+
+    A sweep is the grid of all combinations of the variations given in the configuration file:
+
+        'multi_dialogs_pre':    dialogs_pre with one slot as [list] of options (an empty list for all profiles)
+        'multi_demography':     [dict] with a [list] of options for each demographic key
+        'multi_model':          [list] of model_id
+        'multi_experiment':     [list] of experiments, like [ "news_noimage", "news_image" ]
+        'multi_sampling':       [dict] with a [list] of values for "temperature", "top_p", "max_tokens", "n_returns"
+
+    Each job of the sweep is a [dict] with the configuration parameters overwritten for one execution.
+    The jobs are deduplicated, and the number of requests to the models is estimated before any execution.
+
+    With 'sweep_workers' > 1 the jobs are executed by a pool of processes, with at most 'sweep_limits'
+    runs in parallel for each interface, for example:
+
+        'sweep_workers':        6,
+        'sweep_limits':         { "openai": 4, "anthro": 2 },
+
+    local HuggingFace models share the GPU, and by default run one at a time.
+
+#####################################################################################################################
+"""
+
+import  sys
+import  copy
+import  json
+import  time
+import  itertools
+from    concurrent.futures  import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import  prompt          as prmpt                # this module composes the prompts
+from    models          import models, models_interface
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+
+multi_keys              = (                     # configuration variables that trigger a sweep
+        "multi_dialogs_pre",
+        "multi_demography",
+        "multi_model",
+        "multi_experiment",
+        "multi_sampling",
+)
+sampling_keys           = ( "temperature", "top_p", "max_tokens", "n_returns" )
+experiment_arms         = {                     # number of prompts per news of each experiment
+        "news_noimage"      : 1,
+        "news_image"        : 1,
+        "both"              : 2,
+        "check_news"        : 1,
+}
+default_limits          = {                     # runs in parallel for each interface, if not in sweep_limits
+        "hf"                : 1,
+}
+
+
+# ===================================================================================================================
+#
+#   Planning
+#   - is_sweep
+#   - axes
+#   - job_key
+#   - plan
+#   - shard
+#
+# ===================================================================================================================
+
+def is_sweep():
+    """
+    Return whether the configuration asks for multiple executions
+
+    return:         [bool]
+    """
+    return any( hasattr( cnfg, k ) for k in multi_keys )
+
+
+def axes():
+    """
+    Return the variations of the sweep, as list of configuration parameters each with its list of values
+
+    return:         [list] of [tuple] parameter name and [list] of values
+    """
+    ax      = []
+
+    if hasattr( cnfg, 'multi_dialogs_pre' ):
+        pre_var     = [ pre for pre in cnfg.multi_dialogs_pre if isinstance( pre, list ) ]
+        assert len( pre_var ) == 1, "ERROR: there should be only one multivariation in multi_dialogs_pre"
+        pre_var     = pre_var[ 0 ]
+        idx_var     = cnfg.multi_dialogs_pre.index( pre_var )   # index of the dialog turn with multiple options
+        if not len( pre_var ):                                  # the empty list means use all possible options
+            pre_var = prmpt.list_profiles()                     # that are read from json file
+        values      = []
+        for option in pre_var:
+            dialogs_pre             = copy.deepcopy( cnfg.multi_dialogs_pre )
+            dialogs_pre[ idx_var ]  = option
+            values.append( dialogs_pre )
+        ax.append( ( "dialogs_pre", values ) )
+
+    if hasattr( cnfg, 'multi_demography' ):
+        keys        = cnfg.multi_demography.keys()
+        all_values  = itertools.product( *cnfg.multi_demography.values() )
+        ax.append( ( "demographics", [ dict( zip( keys, v ) ) for v in all_values ] ) )
+
+    if hasattr( cnfg, 'multi_model' ):
+        for i in cnfg.multi_model:
+            assert i < len( models ), f"error: model # {i} not available"
+        ax.append( ( "model_id", list( cnfg.multi_model ) ) )
+
+    if hasattr( cnfg, 'multi_experiment' ):
+        for e in cnfg.multi_experiment:
+            assert e in experiment_arms, f"error: experiment '{e}' not available"
+        ax.append( ( "experiment", list( cnfg.multi_experiment ) ) )
+
+    if hasattr( cnfg, 'multi_sampling' ):
+        for k, values in cnfg.multi_sampling.items():
+            assert k in sampling_keys, f"error: sampling parameter '{k}' cannot be varied"
+            ax.append( ( k, list( values ) ) )
+
+    return ax
+
+
+def job_key( job ):
+    """
+    Return a string identifying the execution of a job, used to detect duplicates
+
+    params:
+        job         [dict] the configuration parameters of the job
+
+    return:         [str]
+    """
+    j       = dict( job )
+    if "model_id" in j:
+        j[ "model_id" ] = models[ j[ "model_id" ] ]     # ids may change, names not
+    if j.get( "experiment", cnfg.experiment ) == "check_news":
+        j.pop( "n_returns", None )                      # just one completion when checking news
+    return json.dumps( j, sort_keys=True )
+
+
+def plan():
+    """
+    Expand the grid of variations into the list of jobs, removing duplicates
+
+    return:         [list] of [dict] with the configuration parameters of each job
+    """
+    ax      = axes()
+    names   = [ name for name, _ in ax ]
+    jobs    = []
+    seen    = set()
+    for values in itertools.product( *[ v for _, v in ax ] ):
+        job     = dict( zip( names, copy.deepcopy( values ) ) )
+        key     = job_key( job )
+        if key in seen:
+            continue
+        seen.add( key )
+        jobs.append( job )
+    return jobs
+
+
+def shard( jobs ):
+    """
+    Split each job in cnfg.queue_shards jobs, each processing a contiguous part of the news
+
+    params:
+        jobs        [list] of [dict] as returned by plan()
+
+    return:         [list] of [dict] with the parameter "news_ids" added when split
+    """
+    n_shards    = min( cnfg.queue_shards, len( cnfg.news_ids ) )
+    if n_shards <= 1:
+        return jobs
+    size        = -( -len( cnfg.news_ids ) // n_shards )       # ceiling division
+    parts       = [ cnfg.news_ids[ i : i + size ] for i in range( 0, len( cnfg.news_ids ), size ) ]
+    return [ dict( job, news_ids=part ) for job in jobs for part in parts ]
+
+
+# ===================================================================================================================
+#
+#   Estimates and description
+#   - n_requests
+#   - describe
+#   - write_plan
+#
+# ===================================================================================================================
+
+def n_requests( job ):
+    """
+    Estimate the number of requests to the model of one job.
+    OpenAI and HuggingFace models return all samples with one request, anthropic models one sample per request.
+
+    params:
+        job         [dict] the configuration parameters of the job
+
+    return:         [int] number of requests
+    """
+    model       = models[ job.get( "model_id", cnfg.model_id ) ].split( '+' )[ 0 ]
+    interface   = models_interface[ models[ job.get( "model_id", cnfg.model_id ) ] ]
+    experiment  = job.get( "experiment", cnfg.experiment )
+    n_returns   = job.get( "n_returns", cnfg.n_returns )
+    if experiment == "check_news":
+        n_returns   = 1
+    prompts     = experiment_arms.get( experiment, 0 ) * len( job.get( "news_ids", cnfg.news_ids ) )
+
+    if model == "no-model":
+        return 0
+    if interface == "anthro":
+        return prompts * n_returns
+    return prompts
+
+
+def describe( job ):
+    """
+    Return a short description of a job
+
+    params:
+        job         [dict] the configuration parameters of the job
+
+    return:         [str]
+    """
+    items   = []
+    for k, v in job.items():
+        if k == "model_id":
+            k, v    = "model", models[ v ]
+        elif k == "demographics":
+            v   = '/'.join( str( d ) for d in v.values() )
+        elif k == "dialogs_pre":
+            v   = ' '.join( v ) if isinstance( v, list ) else v
+        elif k == "news_ids":
+            k, v    = "news", f"{v[ 0 ]}..{v[ -1 ]}"
+        items.append( f"{k}={v}" )
+    return ", ".join( items )
+
+
+def write_plan( fstream, jobs ):
+    """
+    Write the list of jobs of the sweep with their estimated requests
+
+    params:
+        fstream     [TextIOWrapper] text stream of the output file
+        jobs        [list] of [dict] as returned by plan()
+    """
+    total   = 0
+    fstream.write( f"sweep of {len( jobs )} executions:\n" )
+    for i, job in enumerate( jobs ):
+        n       = n_requests( job )
+        total   += n
+        fstream.write( f"{i+1:>5d}  {n:>8d} requests   {describe( job )}\n" )
+    fstream.write( f"total of {total} requests to the models\n\n" )
+
+
+# ===================================================================================================================
+#
+#   Parallel execution
+#   - job_interface
+#   - slots
+#   - write_progress
+#   - run_isolated
+#   - execute
+#
+# ===================================================================================================================
+
+def job_interface( job ):
+    """
+    Return the interface of the model of a job
+
+    params:
+        job         [dict] the configuration parameters of the job
+
+    return:         [str]
+    """
+    return models_interface[ models[ job.get( "model_id", cnfg.model_id ) ] ]
+
+
+def slots( interface, n_workers=None ):
+    """
+    Return the maximum number of runs in parallel for an interface
+
+    params:
+        interface   [str] the interface of the model
+        n_workers   [int] number of processes, or None for cnfg.sweep_workers
+
+    return:         [int]
+    """
+    n_workers   = cnfg.sweep_workers if n_workers is None else n_workers
+    limit       = cnfg.sweep_limits.get( interface, default_limits.get( interface, n_workers ) )
+    return max( 1, min( limit, n_workers ) )
+
+
+def write_progress( fstream, n_done, n_running, n_jobs, req_done, req_total, t_start, msg ):
+    """
+    Write one line with the progress of the sweep
+
+    params:
+        fstream     [TextIOWrapper] text stream of the output
+        n_done      [int] number of completed jobs
+        n_running   [int] number of jobs in execution
+        n_jobs      [int] total number of jobs
+        req_done    [int] estimated requests of the completed jobs
+        req_total   [int] estimated requests of all jobs
+        t_start     [float] start time of the sweep
+        msg         [str] description of the last event
+    """
+    elapsed = time.time() - t_start
+    fstream.write( f"[sweep {n_done}/{n_jobs} done, {n_running} running, "
+                   f"{req_done}/{req_total} requests, {elapsed:.0f}s] {msg}\n" )
+    fstream.flush()
+
+
+def run_isolated( run_job, cfg, job ):
+    """
+    Execute one job in a worker process. The exceptions raised by the clients of remote models cannot
+    always be rebuilt in the main process, and would break the whole pool, so they are passed as RuntimeError
+
+    params:
+        run_job     [function] executing one job, with arguments cfg and job
+        cfg         [load_cnfg.Config] the configuration passed to the worker
+        job         [dict] the configuration parameters of the job
+
+    return:         [str] the folder of results
+    """
+    try:
+        return run_job( cfg, job )
+    except Exception as e:
+        raise RuntimeError( repr( e ) ) from None
+
+
+def execute( jobs, run_job, cfg, n_workers=None ):
+    """
+    Execute the jobs with a pool of n_workers processes, keeping for each interface
+    no more runs in parallel than given by slots().
+    A failed job does not stop the sweep, failures are listed at the end.
+
+    params:
+        jobs        [list] of [dict] as returned by plan()
+        run_job     [function] executing one job, with arguments cfg and job, and returning its folder of results
+        cfg         [load_cnfg.Config] the configuration passed to the workers
+        n_workers   [int] number of processes, or None for cnfg.sweep_workers
+    """
+    n_workers   = cnfg.sweep_workers if n_workers is None else n_workers
+    n_jobs      = len( jobs )
+    req         = [ n_requests( job ) for job in jobs ]
+    req_total   = sum( req )
+    req_done    = 0
+    waiting     = list( range( n_jobs ) )
+    running     = dict()                            # future -> index of the job
+    per_iface   = dict()                            # number of running jobs for each interface
+    failed      = []
+    t_start     = time.time()
+
+    with ProcessPoolExecutor( max_workers=n_workers ) as pool:
+        while waiting or running:
+            # submit all the waiting jobs that find a free slot of their interface
+            for i in list( waiting ):
+                if len( running ) >= n_workers:
+                    break
+                iface   = job_interface( jobs[ i ] )
+                if per_iface.get( iface, 0 ) >= slots( iface, n_workers ):
+                    continue
+                waiting.remove( i )
+                per_iface[ iface ]  = per_iface.get( iface, 0 ) + 1
+                running[ pool.submit( run_isolated, run_job, cfg, jobs[ i ] ) ]    = i
+                write_progress( sys.stdout, n_jobs - len( waiting ) - len( running ), len( running ), n_jobs,
+                                req_done, req_total, t_start, f"run {i+1} started: {describe( jobs[ i ] )}" )
+
+            done, _     = wait( running, return_when=FIRST_COMPLETED )
+            for f in done:
+                i       = running.pop( f )
+                iface   = job_interface( jobs[ i ] )
+                per_iface[ iface ]  -= 1
+                req_done            += req[ i ]
+                if f.exception() is not None:
+                    failed.append( i )
+                    msg     = f"run {i+1} FAILED: {f.exception()}"
+                else:
+                    msg     = f"run {i+1} done in {f.result()}"
+                write_progress( sys.stdout, n_jobs - len( waiting ) - len( running ), len( running ), n_jobs,
+                                req_done, req_total, t_start, msg )
+
+    for i in failed:
+        print( f"ERROR: run {i+1} failed: {describe( jobs[ i ] )}" )
@@ -0,0 +1,127 @@
+"""
+#####################################################################################################################
+
+    Module to access the dialogs composing the prompts
+
+    The JSON files of dialogs and of demographics are read once for each process. Each dialog is kept
+    with its text for news with and without image, and the demographic combinations are validated,
+    and the dialogs filled with them, only the first time they are used.
+
+#####################################################################################################################
+"""
+
+import  os
+import  json
+
+registries              = dict()                # DialogRegistry for each pair of files already read
+
+
+# ===================================================================================================================
+#
+#   - DialogRegistry
+#   - get_registry
+#
+# ===================================================================================================================
+
+class DialogRegistry( object ):
+    """
+    Dialogs of one JSON file, indexed by id, with the demographic data of another JSON file
+    """
+
+    def __init__( self, fdialog, fdemo=None ):
+        """
+        params:
+            fdialog     [str] JSON file of the dialogs, with path
+            fdemo       [str] JSON file of the demographic data, with path, or None
+        """
+        with open( fdialog, 'r' ) as f:
+            data        = json.load( f )
+        self.fdemo      = fdemo
+        self.order      = [ d[ 'id' ] for d in data ]
+        self.texts      = dict()                # ( id, with_img ) -> text with the {content_dems} slot
+        self.compl      = dict()                # id -> flag that the chat mode is chat-completion
+        for d in data:
+            self.texts[ ( d[ 'id' ], False ) ]  = d[ "content" ]
+            self.texts[ ( d[ 'id' ], True ) ]   = d.get( "content_img", d[ "content" ] )
+            self.compl[ d[ 'id' ] ]             = "completion_mode" in d.keys()
+        self.dems       = self.texts.get( ( "content_dems", False ) )
+        self.valid      = None                  # demographic options, read when first needed
+        self.filled     = dict()                # demographics key -> content_dems filled
+        self.rendered   = dict()                # ( id, with_img, demographics key ) -> text
+
+
+    def __contains__( self, id_dialog ):
+        return id_dialog in self.compl
+
+
+    def ids( self ):
+        """
+        return:         [list] of [str] the ids of all dialogs, in the order of the file
+        """
+        return list( self.order )
+
+
+    def fill_dems( self, demographics ):
+        """
+        Validate a demographic combination and fill content_dems with it, the first time it is used
+
+        params:
+            demographics [dict] demographic details
+
+        return:         [str] content_dems filled
+        """
+        key     = tuple( sorted( demographics.items() ) )
+        if key in self.filled:
+            return self.filled[ key ]
+
+        if self.valid is None:
+            with open( self.fdemo, 'r' ) as f:
+                self.valid  = json.load( f )
+
+        # Validate demographics against available options
+        for k, value in demographics.items():
+            if k not in self.valid or value not in self.valid[ k ]:
+                raise ValueError( f"Invalid demographic value: {k} = {value}" )
+
+        if self.dems is None:
+            raise ValueError( f"ERROR: Missing 'content_dems' entry in {self.fdemo}" )
+
+        self.filled[ key ]  = self.dems.format( **demographics )
+        return self.filled[ key ]
+
+
+    def render( self, id_dialog, with_img, demographics=None ):
+        """
+        Return the text of a dialog, with the demographic details in the {content_dems} slot
+
+        params:
+            id_dialog   [str] ID of the dialog
+            with_img    [bool] the news contains an image
+            demographics [dict] demographic details, or None
+
+        return:         [str] the dialog content
+                        [bool] flag that the chat mode is chat-completion
+        """
+        dkey    = tuple( sorted( demographics.items() ) ) if demographics else None
+        key     = ( id_dialog, with_img, dkey )
+        if key not in self.rendered:
+            text    = self.texts[ ( id_dialog, with_img ) ]
+            dems    = self.fill_dems( demographics ) if demographics else ''
+            self.rendered[ key ]    = text.replace( "{content_dems}", dems )
+        return self.rendered[ key ], self.compl[ id_dialog ]
+
+
+def get_registry( fdialog, fdemo=None ):
+    """
+    Return the registry of a file of dialogs, reading it the first time
+
+    params:
+        fdialog     [str] JSON file of the dialogs, with path
+        fdemo       [str] JSON file of the demographic data, with path, or None
+
+    return:         [DialogRegistry]
+    """
+    key     = ( os.path.abspath( fdialog ), fdemo and os.path.abspath( fdemo ) )
+    if key not in registries:
+        registries[ key ]   = DialogRegistry( fdialog, fdemo )
+    return registries[ key ]
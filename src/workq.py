@@ -0,0 +1,257 @@
+"""
+#####################################################################################################################
+
+    Module to share the jobs of a sweep among workers on several hosts
+
+    The jobs are kept in an SQLite file, that should be on a filesystem visible to all the hosts.
+    A job is a [dict] of configuration parameters, as planned by sweep.py, possibly restricted to a shard
+    of the news with the parameter "news_ids".
+
+    A worker takes a job with a lease of cnfg.queue_lease seconds, renewed by a heartbeat while the job
+    is executed. When a worker crashes its lease expires, and the job is taken by another worker.
+    A job failing cnfg.queue_attempts times, or whose last lease expires, is not taken anymore.
+    Workers without jobs keep waiting while other jobs are leased, to take them if their leases expire.
+
+    NOTE: SQLite relies on the file locks of the filesystem, that should be working on the shared
+    filesystem (for NFS, the lock daemon should be active)
+
+#####################################################################################################################
+"""
+
+import  os
+import  json
+import  time
+import  socket
+import  sqlite3
+import  threading
+
+cnfg                    = None                  # parameter obj assigned by main_exec.py
+
+job_states              = ( "waiting", "leased", "done", "failed" )
+
+
+# ===================================================================================================================
+#
+#   Queue
+#   - connect
+#   - owner
+#   - fill
+#   - lease
+#   - n_leased
+#   - renew
+#   - finish
+#   - write_status
+#
+# ===================================================================================================================
+
+def connect():
+    """
+    Open the queue file, creating it if necessary.
+    Transactions are managed explicitly, a new connection is used by each thread.
+
+    return:         [sqlite3.Connection]
+    """
+    db      = sqlite3.connect( cnfg.queue_file, timeout=60, isolation_level=None )
+    db.execute( "CREATE TABLE IF NOT EXISTS jobs ( "
+                "id INTEGER PRIMARY KEY, key TEXT UNIQUE, job TEXT, state TEXT, owner TEXT, "
+                "lease_until REAL, attempts INTEGER, result TEXT, updated REAL )" )
+    return db
+
+
+def owner():
+    """
+    Return the identifier of this worker
+
+    return:         [str] host name and process id
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def fill( jobs, keys ):
+    """
+    Add jobs to the queue, skipping those already present
+
+    params:
+        jobs        [list] of [dict] configuration parameters of the jobs
+        keys        [list] of [str] identifying each job
+
+    return:         [int] number of jobs added
+    """
+    db      = connect()
+    now     = time.time()
+    rows    = [ ( k, json.dumps( j ), "waiting", None, 0., 0, None, now ) for j, k in zip( jobs, keys ) ]
+    db.execute( "BEGIN IMMEDIATE" )
+    before  = db.execute( "SELECT COUNT(*) FROM jobs" ).fetchone()[ 0 ]
+    db.executemany( "INSERT OR IGNORE INTO jobs "
+                    "( key, job, state, owner, lease_until, attempts, result, updated ) "
+                    "VALUES ( ?, ?, ?, ?, ?, ?, ?, ? )", rows )
+    after   = db.execute( "SELECT COUNT(*) FROM jobs" ).fetchone()[ 0 ]
+    db.execute( "COMMIT" )
+    db.close()
+    return after - before
+
+
+def lease():
+    """
+    Take the first job waiting, or with an expired lease.
+    The jobs with expired lease and no attempts left are marked as failed
+
+    return:         [tuple] with job id and [dict] of the job, or None if there are no jobs available
+    """
+    db      = connect()
+    now     = time.time()
+    db.execute( "BEGIN IMMEDIATE" )                 # lock the file until the lease is written
+    db.execute( "UPDATE jobs SET state = 'failed', result = 'lease expired', updated = ? "
+                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", ( now, now, cnfg.queue_attempts ) )
+    row     = db.execute( "SELECT id, job FROM jobs WHERE attempts < ? AND "
+                          "( state = 'waiting' OR ( state = 'leased' AND lease_until < ? ) ) "
+                          "ORDER BY id LIMIT 1", ( cnfg.queue_attempts, now ) ).fetchone()
+    if row is not None:
+        db.execute( "UPDATE jobs SET state = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1, "
+                    "updated = ? WHERE id = ?", ( owner(), now + cnfg.queue_lease, now, row[ 0 ] ) )
+    db.execute( "COMMIT" )
+    db.close()
+    if row is None:
+        return None
+    return row[ 0 ], json.loads( row[ 1 ] )
+
+
+def n_leased():
+    """
+    return:         [int] number of jobs leased by workers
+    """
+    db      = connect()
+    n       = db.execute( "SELECT COUNT(*) FROM jobs WHERE state = 'leased'" ).fetchone()[ 0 ]
+    db.close()
+    return n
+
+
+def renew( job_id ):
+    """
+    Extend the lease of a job
+
+    params:
+        job_id      [int] id of the job
+
+    return:         [bool] False if the lease was lost, because it expired and was taken by another worker
+    """
+    db      = connect()
+    now     = time.time()
+    cur     = db.execute( "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                          ( now + cnfg.queue_lease, now, job_id, owner() ) )
+    db.close()
+    return cur.rowcount == 1
+
+
+def finish( job_id, result=None, error=None ):
+    """
+    Record the end of a job. A failed job goes back to the queue, unless it exhausted its attempts
+
+    params:
+        job_id      [int] id of the job
+        result      [str] the folder of results
+        error       [str] the error of a failed job, or None
+    """
+    db      = connect()
+    now     = time.time()
+    db.execute( "BEGIN IMMEDIATE" )
+    if error is None:
+        db.execute( "UPDATE jobs SET state = 'done', result = ?, updated = ? WHERE id = ? AND owner = ?",
+                    ( result, now, job_id, owner() ) )
+    else:
+        db.execute( "UPDATE jobs SET state = CASE WHEN attempts < ? THEN 'waiting' ELSE 'failed' END, "
+                    "result = ?, updated = ? WHERE id = ? AND owner = ?",
+                    ( cnfg.queue_attempts, error, now, job_id, owner() ) )
+    db.execute( "COMMIT" )
+    db.close()
+
+
+def write_status( fstream ):
+    """
+    Write the number of jobs in each state, and the jobs leased or failed
+
+    params:
+        fstream     [TextIOWrapper] text stream of the output
+    """
+    db      = connect()
+    now     = time.time()
+    counts  = dict( db.execute( "SELECT state, COUNT(*) FROM jobs GROUP BY state" ).fetchall() )
+    fstream.write( "jobs:  " + ",  ".join( f"{s} {counts.get( s, 0 )}" for s in job_states ) + "\n" )
+    for job_id, state, who, until, attempts, result in db.execute(
+            "SELECT id, state, owner, lease_until, attempts, result FROM jobs "
+            "WHERE state IN ( 'leased', 'failed' ) ORDER BY id" ):
+        if state == "leased":
+            expiry  = "expired" if until < now else f"{until - now:.0f}s left"
+            fstream.write( f"{job_id:>5d}  leased by {who} ({expiry}), attempt {attempts}\n" )
+        else:
+            fstream.write( f"{job_id:>5d}  failed after {attempts} attempts: {result}\n" )
+    db.close()
+
+
+# ===================================================================================================================
+#
+#   Worker
+#   - Heartbeat
+#   - work
+#
+# ===================================================================================================================
+
+class Heartbeat( threading.Thread ):
+    """
+    Thread renewing the lease of a job until stopped
+    """
+
+    def __init__( self, job_id ):
+        """
+        params:
+            job_id      [int] id of the job
+        """
+        super().__init__( daemon=True )
+        self.job_id     = job_id
+        self.halt       = threading.Event()
+
+
+    def run( self ):
+        while not self.halt.wait( cnfg.queue_lease / 3 ):
+            if not renew( self.job_id ):
+                print( f"WARNING: lease of job {self.job_id} lost, its results may be duplicated" )
+                return
+
+
+    def stop( self ):
+        self.halt.set()
+        self.join()
+
+
+def work( run_job ):
+    """
+    Execute jobs from the queue until there are no more available, waiting while other workers hold jobs
+    that may be released by the expiry of their leases
+
+    params:
+        run_job     [function] executing one job, with argument the job, and returning its folder of results
+
+    return:         [int] number of jobs executed
+    """
+    n_done  = 0
+    while True:
+        leased  = lease()
+        if leased is None:
+            if n_leased() == 0:
+                return n_done
+            time.sleep( cnfg.queue_lease / 3 )
+            continue
+        job_id, job = leased
+        print( f"** job {job_id} leased by {owner()} **" )
+        beat    = Heartbeat( job_id )
+        beat.start()
+        try:
+            result  = run_job( job )
+        except Exception as e:
+            beat.stop()
+            print( f"ERROR: job {job_id} failed: {e}" )
+            finish( job_id, error=repr( e ) )
+            continue
+        beat.stop()
+        finish( job_id, result=result )
+        n_done  += 1